@@ -3,9 +3,20 @@
 """
 
 # Prelims
+import argparse
+import hashlib
 import numpy as np
 import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
 from PIL import Image
+import cv2
 import matplotlib.pyplot as plt
 import pandas as pd
 #!pip install rawpy # <- Google colab format
@@ -21,68 +32,196 @@ import torch
 import torch.utils.data
 import torchvision
 
+from crop_store import new_store_shard, record_stored, write_store_row
+
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
-# Where are the new RAW images that will need to be changed before modeling?
-img_dir = input("Please provide a directory path that has the images awaiting\
- analysis.\n")
+# rawpy.postprocess settings for each demosaic profile. "ahd" is LibRaw's
+# default full-resolution AHD demosaic. "linear" is full resolution with the
+# cheaper bilinear demosaic. "half" skips demosaicing altogether and builds each
+# RGB pixel from one 2x2 Bayer block, giving an image half as wide and high.
+# "roi" isn't a postprocess setting: see decode_roi.
+DEMOSAIC_PROFILES = {
+    "ahd": dict(use_camera_wb=True),
+    "linear": dict(use_camera_wb=True,
+                   demosaic_algorithm=rawpy.DemosaicAlgorithm.LINEAR),
+    "half": dict(use_camera_wb=True, half_size=True),
+    "roi": None,
+}
 
-if os.path.exists(img_dir) == False:
-  raise TypeError("The path provided does not exist. Do you need to provide a\
-  leading '/' (on Windows, you need to provide 'C:\' instead).")
+# Kind of capture a file is, by its extension in lower case and without the dot
+# ('dng', 'jpg', ...). Every check of a capture's extension goes through this,
+# so cameras that name files in upper case (CAP_00.JPG, CAP_00.DNG) are handled
+# the same way everywhere.
+def capture_type(img_name):
+    return os.path.splitext(img_name)[1][1:].lower()
 
-print("The directory provided was {}.".format(img_dir))
+# Horizontal images are turned upright.
+def orient(post_im):
+    if post_im.shape[0] < post_im.shape[1]:
+        post_im = np.rot90(post_im, 3)
+        print("Note: horizontal images detected. Inspect orientation.")
+    return post_im
 
-# Names and locations of images for reading.
-rawimgs = sorted(os.listdir(img_dir))
-rawimgs_dir = list()
+# Read a RAW (DNG) image, postprocess, and check orientation. Returns the RGB
+# np.ndarray. The rawpy handle is closed as soon as the array has been made, so
+# nothing of the RAW file is kept around.
+def load_raw(img_path, demosaic="ahd"):
+    with rawpy.imread(img_path) as raw:
+        post_im = raw.postprocess(**DEMOSAIC_PROFILES[demosaic])
+    return orient(post_im)
 
-for i in range(len(rawimgs)):
-    rawimgs_dir.append(os.path.join(img_dir , rawimgs[i]))
+# Decode only the newsize x newsize region in the middle of the sensor, at half
+# resolution. Each 2x2 Bayer block of the region becomes one RGB pixel (the two
+# greens are averaged) after black level subtraction and the camera's white
+# balance, and is then put through the camera's colour matrix, auto-brightened so
+# 1% of the pixels clip (LibRaw's default) and given LibRaw's default BT.709
+# gamma. The rest of the sensor is never touched. This is an approximation of
+# postprocess, not a copy of it; compare_demosaic shows how close it gets.
+def decode_roi(img_path, newsize):
+    with rawpy.imread(img_path) as raw:
+        bayer = raw.raw_image_visible
+        height, width = bayer.shape
+        # Keep the region on even rows/columns so the Bayer pattern lines up.
+        side = int(newsize) & ~1
+        top = ((height - side)//2) & ~1
+        left = ((width - side)//2) & ~1
+        roi = bayer[top:top+side, left:left+side].astype(np.float32)
+        pattern = raw.raw_pattern
+        black = np.array(raw.black_level_per_channel, dtype=np.float32)
+        white = float(raw.white_level)
+        wb = np.array(raw.camera_whitebalance, dtype=np.float32)
+        color_matrix = np.array(raw.color_matrix, dtype=np.float32)[:, :3]
+        flip = raw.sizes.flip
+    # Second green has no multiplier of its own in some files.
+    if wb[3] == 0:
+        wb[3] = wb[1]
+    wb = wb / wb[1]
+    planes = np.zeros((side//2, side//2, 4), dtype=np.float32)
+    for dy in (0, 1):
+        for dx in (0, 1):
+            c = pattern[dy, dx]
+            planes[..., c] = (roi[dy::2, dx::2] - black[c]) * wb[c] / (white - black[c])
+    cam = np.stack((planes[..., 0], (planes[..., 1] + planes[..., 3])/2,
+                    planes[..., 2]), axis=-1)
+    rgb = np.clip(cam @ color_matrix.T, 0, None)
+    rgb = np.clip(rgb / max(np.percentile(rgb, 99), 1e-6), 0, 1)
+    rgb = np.where(rgb < 0.018, 4.5*rgb, 1.099*rgb**0.45 - 0.099)
+    post_im = (rgb*255 + 0.5).astype(np.uint8)
+    # LibRaw flip codes: 3 = 180, 5 = 90 counter-clockwise, 6 = 90 clockwise.
+    post_im = np.rot90(post_im, {3: 2, 5: 1, 6: 3}.get(flip, 0))
+    return orient(post_im)
 
-# Read RAW images, postprocess, and check orientation.
-raw_in_list = list()
-post_im_list = list()
+# Bring a half-resolution crop back up to newsize x newsize, so it covers the
+# same part of the chip at the same size as a full-resolution crop.
+def upscale(crop, newsize):
+    return Image.fromarray(np.ascontiguousarray(crop)).resize((newsize, newsize),
+                                                              Image.BILINEAR)
 
-for ind, img in enumerate(rawimgs_dir):
-    if img.endswith('dng'):
-        raw_in_list.append(rawpy.imread(img))
-        post_im_list.append(raw_in_list[ind].postprocess(use_camera_wb=True))
-        if post_im_list[ind].shape[0] < post_im_list[ind].shape[1]:
-            post_im_list[ind] = np.rot90(post_im_list[ind], 3)
-            print("Note: horizontal images detected. Inspect orientation.")
+# Decode a DNG with one of the DEMOSAIC_PROFILES. Returns the whole postprocessed
+# frame (None for "roi", and half-size for "half") and the center crop as a
+# newsize x newsize PIL Image. With locate the crop is taken around the chip
+# instead (see chip_crop); "roi" only has the middle of the sensor to look at,
+# so it can't be combined with locate.
+def decode_crop(img_path, newsize, demosaic="ahd", locate=False):
+    cropper = chip_crop if locate else crop_array
+    if demosaic == "roi":
+        if locate:
+            raise ValueError("The 'roi' demosaic can't be combined with locate.")
+        return None, upscale(decode_roi(img_path, newsize), newsize)
+    post_im = load_raw(img_path, demosaic)
+    if demosaic == "half":
+        return post_im, upscale(cropper(post_im, newsize//2), newsize)
+    return post_im, Image.fromarray(cropper(post_im, newsize))
+
+# Green mean of each quadrant of an RGB crop.
+def green_quadrants(crop):
+    green = np.asarray(crop)[..., 1].astype(np.float64)
+    v_half = green.shape[0]//2
+    h_half = green.shape[1]//2
+    return np.array([green[:v_half, :h_half].mean(), green[:v_half, h_half:].mean(),
+                     green[v_half:, :h_half].mean(), green[v_half:, h_half:].mean()])
+
+# Decode every DNG in src with both the full AHD profile and demosaic, and
+# report how far the crops are apart: mean and max absolute pixel difference
+# over all channels, the largest difference in quadrant green means (the values
+# the green scores are built on), and the decode time of each.
+def compare_demosaic(src, size=1900, demosaic="half"):
+    report = list()
+    for img_name in sorted(os.listdir(src)):
+        if capture_type(img_name) != 'dng':
+            continue
+        img_path = os.path.join(src, img_name)
+        start = time.perf_counter()
+        ref = np.asarray(decode_crop(img_path, size, "ahd")[1], dtype=np.float64)
+        ahd_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        fast = np.asarray(decode_crop(img_path, size, demosaic)[1], dtype=np.float64)
+        seconds = time.perf_counter() - start
+        diff = np.abs(ref - fast)
+        report.append(dict(image=img_path, demosaic=demosaic,
+                           mean_abs_diff=float(diff.mean()),
+                           max_abs_diff=float(diff.max()),
+                           green_diff=float(np.abs(green_quadrants(ref)
+                                                   - green_quadrants(fast)).max()),
+                           ahd_seconds=ahd_seconds, seconds=seconds,
+                           speedup=ahd_seconds / seconds))
+    return report
+
+# Read a RAW (DNG) or JPG image, postprocess, and check orientation. Returns a
+# PIL Image either way.
+def load_image(img_path):
+    if capture_type(img_path) == 'dng':
+        post_im = Image.fromarray(load_raw(img_path))
     else:
-        raw_in_list.append(Image.open(img))
-        post_im_list.append(Image.open(img))
-        if post_im_list[ind].size[0] > post_im_list[ind].size[1]:
-            post_im_list[ind] = post_im_list[ind].rotate(90)
+        post_im = Image.open(img_path)
+        if post_im.size[0] > post_im.size[1]:
+            post_im = post_im.rotate(90)
             print("Note: horizontal images detected. Inspect orientation.")
+    return post_im
+
+# DNG and JPG captures are saved as PNG. Anything else keeps its name.
+def png_name(img_name):
+    if capture_type(img_name) in ('dng', 'jpg'):
+        return os.path.splitext(img_name)[0] + ".png"
+    return img_name
 
-# Save images as PNG full-size.
-dir_save = input("Please provide a directory path for saving full-size images.\n")
-
-if os.path.exists(dir_save) == False:
-    new_dir_response = input("Directory does not exist. Should it be created? [Yes or No] If so, we will use {}\n".format(dir_save)) or "No"
-    if new_dir_response == "Yes":
-      os.mkdir(dir_save)
-
-newnamelis = list()
-save_names_path = list()
-
-for i in range(len(rawimgs)):
-    if rawimgs[i].endswith('dng'):
-        newnamelis.append(rawimgs[i].replace("dng","png"))
-        save_names_path.append(os.path.join(dir_save, newnamelis[i]))
-        post_im_list[i] = Image.fromarray(post_im_list[i])
-        post_im_list[i].save(save_names_path[i])
-    elif rawimgs[i].endswith('jpg'):
-        newnamelis.append(rawimgs[i].replace("jpg","png"))
-        save_names_path.append(os.path.join(dir_save, newnamelis[i]))
-        post_im_list[i].save(save_names_path[i])
+# File extension for each output format (see save_image).
+OUTPUT_FORMATS = {
+    "png": ".png",
+    "tiff": ".tiff",
+    "npy": ".npy",
+    "webp": ".webp",
+}
+
+# Output name for img_name. PNG keeps the names png_name gives; other formats
+# swap the extension.
+def output_name(img_name, fmt="png"):
+    new_name = png_name(img_name)
+    if fmt != "png":
+        new_name = os.path.splitext(new_name)[0] + OUTPUT_FORMATS[fmt]
+    return new_name
+
+# Write img (PIL Image or np.ndarray) to path as one of the OUTPUT_FORMATS:
+#   "png"  - zlib compressed PNG; compress_level 0 (none, fastest) to 9
+#            (smallest, slowest). 6 is PIL's default.
+#   "tiff" - uncompressed TIFF.
+#   "npy"  - the raw uint8 array, for np.load / np.memmap.
+#   "webp" - lossless WebP.
+def save_image(img, path, fmt="png", compress_level=6):
+    if fmt == "npy":
+        np.save(path, np.asarray(img))
+        return
+    if not isinstance(img, Image.Image):
+        img = Image.fromarray(np.ascontiguousarray(img))
+    if fmt == "png":
+        img.save(path, compress_level=compress_level)
+    elif fmt == "tiff":
+        img.save(path, format="TIFF", compression=None)
+    elif fmt == "webp":
+        img.save(path, format="WEBP", lossless=True)
     else:
-        newnamelis.append(rawimgs[i])
-        save_names_path.append(os.path.join(dir_save, newnamelis[i]))
-        post_im_list[i].save(save_names_path[i])
+        raise ValueError("fmt must be one of {}, not {}".format(list(OUTPUT_FORMATS), fmt))
 
 # The if statement here is dodgy. An array or tensor has shape AND size. Only
 # the PIL Images have only shape. Tried using type(img), but that's only for
@@ -97,36 +236,601 @@ def centercrop(img, newsize):
         print("img is PIL. widt = {}, height = {}".format(width,height))
     left = int((width - int(newsize))/2)
     top = int((height - int(newsize))/2)
-    bottom = int(height - top)
-    right = int(width - left)
+    # newsize from the top left, so odd margins don't make it a pixel bigger
+    bottom = top + int(newsize)
+    right = left + int(newsize)
     # Crop the center of the image
     ccrp = img.crop((left, top, right, bottom))
     return ccrp
 
-# Crop images. 1600 x 1600
-cencrop_lis = list()
+# The (left, top, right, bottom) box of an np.ndarray. Where the box is inside
+# the picture this is a slice, a view, so only the cropped pixels are ever
+# copied (by Image.fromarray when saving). Where it reaches past the edges, the
+# part outside is black, as PIL's Image.crop does it, so the crop always has
+# the size of the box.
+def crop_box(img, left, top, right, bottom):
+    height, width = img.shape[:2]
+    if left >= 0 and top >= 0 and right <= width and bottom <= height:
+        return img[top:bottom, left:right]
+    out = np.zeros((bottom - top, right - left) + img.shape[2:], dtype=img.dtype)
+    src_top, src_left = max(top, 0), max(left, 0)
+    src_bottom, src_right = min(bottom, height), min(right, width)
+    if src_top < src_bottom and src_left < src_right:
+        out[src_top - top:src_bottom - top, src_left - left:src_right - left] = \
+            img[src_top:src_bottom, src_left:src_right]
+    return out
+
+# Same crop as centercrop, but for an np.ndarray (see crop_box). An image
+# smaller than newsize is padded with black, as centercrop pads it.
+def crop_array(img, newsize):
+    height, width = img.shape[:2]   # Get dimensions
+    left = int((width - int(newsize))/2)
+    top = int((height - int(newsize))/2)
+    # newsize from the top left, so odd margins don't make it a pixel bigger
+    bottom = top + int(newsize)
+    right = left + int(newsize)
+    return crop_box(img, left, top, right, bottom)
+
+# Where a crop of size starts along a side of the picture of the given length,
+# to be as close to centered on center as it can while staying inside the
+# picture. A picture shorter than the crop is centered in it instead, and padded
+# on both sides as centercrop does.
+def crop_start(center, size, length):
+    if length < size:
+        return int((length - size)/2)
+    return min(max(int(center - size/2), 0), length - size)
+
+# Find the chip in an RGB np.ndarray. Works on a copy shrunk so its long side is
+# about 512 px: Otsu threshold of the grey image (both ways round, since the chip
+# may be lighter or darker than what's behind it), a morphological close, and
+# the largest contour that doesn't touch the edge of the picture. Returns the
+# chip's center in full-resolution (x, y) and how far it is rotated from square
+# to the picture in degrees (within +-45), or None if nothing chip-like is found.
+def locate_chip(img, long_side=512):
+    step = max(1, max(img.shape[:2]) // long_side)
+    small = np.ascontiguousarray(img[::step, ::step])
+    grey = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), (5, 5), 0)
+    kernel = np.ones((7, 7), np.uint8)
+    best = None
+    for flag in (cv2.THRESH_BINARY, cv2.THRESH_BINARY_INV):
+        mask = cv2.threshold(grey, 0, 255, flag + cv2.THRESH_OTSU)[1]
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+        contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if x == 0 or y == 0 or x + w >= mask.shape[1] or y + h >= mask.shape[0]:
+                continue
+            area = cv2.contourArea(contour)
+            if best is None or area > best[0]:
+                best = (area, contour)
+    # Anything under 1% of the picture is noise, not a chip.
+    if best is None or best[0] < 0.01 * grey.size:
+        return None
+    (cx, cy), _, angle = cv2.minAreaRect(best[1])
+    angle = (angle + 45) % 90 - 45
+    return cx * step, cy * step, angle
+
+# Crop newsize x newsize around the chip found by locate_chip, turned square to
+# the picture, instead of blindly taking the middle. Only a window just big
+# enough for the rotated crop is rotated, never the whole frame. The crop is
+# kept inside the picture, and padded with black where the picture is smaller
+# than newsize, so it is always newsize x newsize; if no chip is found this is
+# the same as crop_array.
+# Only tilts of up to 45 degrees are undone. The outline of the chip doesn't
+# tell which way up it is, so a chip photographed a quarter or half turn round
+# stays that way; orient only turns landscape frames upright.
+def chip_crop(img, newsize):
+    height, width = img.shape[:2]
+    found = locate_chip(img)
+    if found is None:
+        print("Note: no chip found. Using the center crop.")
+        return crop_array(img, newsize)
+    cx, cy, angle = found
+    if abs(angle) < 0.5:
+        left = crop_start(cx, newsize, width)
+        top = crop_start(cy, newsize, height)
+        return crop_box(img, left, top, left + newsize, top + newsize)
+    side = min(int(np.ceil(newsize * np.sqrt(2))) + 2, height, width)
+    left = min(max(int(cx - side/2), 0), width - side)
+    top = min(max(int(cy - side/2), 0), height - side)
+    window = np.ascontiguousarray(img[top:top+side, left:left+side])
+    rot = cv2.getRotationMatrix2D((cx - left, cy - top), angle, 1.0)
+    # Move the chip's center to the middle of the output.
+    rot[0, 2] += newsize/2 - (cx - left)
+    rot[1, 2] += newsize/2 - (cy - top)
+    return cv2.warpAffine(window, rot, (newsize, newsize), flags=cv2.INTER_LINEAR)
+
+# Streaming ingestion. Each image is decoded, rotated, saved full-size, center
+# cropped and saved cropped before the next one is read. Only one image is held
+# in memory at a time, regardless of how many files are in the directory.
+#
+# full controls the full-size image, which is the most expensive encode:
+#   "save"  - write it, then the crop (the original behaviour).
+#   "async" - write it on a background thread while the crop is encoded. Both
+#             are finished before this returns.
+#   "skip"  - don't write it at all; full_path is ignored.
+# DNGs are cropped straight from the demosaiced array, without making a PIL copy
+# of the whole frame unless the full-size image is written. The saved crop is
+# the same either way.
+# demosaic picks one of the DEMOSAIC_PROFILES for DNGs. With "half" the
+# full-size image is half-size; "roi" only decodes the crop, so full must be
+# "skip".
+# fmt and compress_level are passed to save_image for both outputs.
+# With a writer (a ThreadPoolExecutor) the encodes are handed to it and this
+# returns as soon as the image is decoded, so the next decode can start while
+# they run. The returned dict then has a "writes" list of futures that must be
+# finished with finish_writes before the outputs can be used.
+# store_row is a (shard path, row) pair from new_store_shard; if given, the crop
+# is also copied into that row of the crop store (see crop_store.py).
+# With locate the crop follows the chip rather than the middle of the picture
+# (see chip_crop).
+# Returns the paths written and how long the file took, in seconds.
+def ingest_image(img_path, full_path, crop_path, newsize, full="save",
+                 demosaic="ahd", fmt="png", compress_level=6, store_row=None,
+                 locate=False, writer=None):
+    if demosaic == "roi" and full != "skip":
+        raise ValueError("The 'roi' demosaic only decodes the crop; use full='skip'.")
+    if full not in ("save", "async", "skip"):
+        raise ValueError("full must be 'save', 'async' or 'skip', not {}".format(full))
+    start = time.perf_counter()
+    if capture_type(img_path) == 'dng':
+        post_im, crop = decode_crop(img_path, newsize, demosaic, locate)
+    else:
+        post_im = load_image(img_path)
+        if locate:
+            crop = Image.fromarray(chip_crop(np.asarray(post_im.convert("RGB")), newsize))
+        else:
+            crop = centercrop(post_im, newsize)
+    save_full = lambda: save_image(post_im, full_path, fmt, compress_level)
+    # Crop images. 1600 x 1600
+    save_crop = lambda: save_image(crop, crop_path, fmt, compress_level)
+    if full == "skip":
+        full_path = None
+    res = dict(image=img_path, full=full_path, crop=crop_path, start=start)
+
+    if store_row is not None:
+        shard_path, row = store_row
+        write_store_row(shard_path, row, crop.convert("RGB"))
+        res["shard"] = os.path.basename(shard_path)
+        res["row"] = row
+
+    if writer is not None:
+        res["writes"] = [writer.submit(save_crop)]
+        if full != "skip":
+            res["writes"].append(writer.submit(save_full))
+        return res
+
+    if full == "save":
+        save_full()
+        save_crop()
+    elif full == "async":
+        full_writer = threading.Thread(target=save_full)
+        full_writer.start()
+        save_crop()
+        full_writer.join()
+    else:
+        save_crop()
+    return finish_writes(res)
+
+# Wait for any encodes ingest_image handed to a writer and fill in how long the
+# file took from the start of its decode.
+def finish_writes(res):
+    for future in res.pop("writes", []):
+        future.result()
+    res["seconds"] = time.perf_counter() - res.pop("start")
+    return res
+
+# Processed-file manifest. A SQLite table with one row per source image,
+# keyed by its path, with the size, mtime and SHA-256 of the file when it was
+# ingested and the crop size, demosaic profile and outputs that were written.
+# Lets ingest skip anything that has already been done.
+def open_manifest(path):
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS processed (
+                        source TEXT PRIMARY KEY,
+                        size INTEGER,
+                        mtime REAL,
+                        sha256 TEXT,
+                        crop_size INTEGER,
+                        demosaic TEXT,
+                        full TEXT,
+                        crop TEXT,
+                        processed_at REAL)""")
+    conn.commit()
+    return conn
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# Has img_path already been ingested with the same settings, and are its outputs
+# still there? The size and mtime are checked first; the file is only hashed
+# when they have changed, in case it was copied or touched without being edited.
+def already_ingested(conn, img_path, full_path, crop_path, newsize, full, demosaic):
+    row = conn.execute("SELECT size, mtime, sha256, crop_size, demosaic, full, crop"
+                       " FROM processed WHERE source = ?", (img_path,)).fetchone()
+    if row is None:
+        return False
+    size, mtime, sha256, crop_size, done_demosaic, done_full, done_crop = row
+    if (crop_size != newsize or done_demosaic != demosaic or done_crop != crop_path
+            or not os.path.exists(crop_path)):
+        return False
+    if full != "skip" and (done_full != full_path or not os.path.exists(full_path)):
+        return False
+    stat = os.stat(img_path)
+    if stat.st_size == size and stat.st_mtime == mtime:
+        return True
+    if stat.st_size == size and file_hash(img_path) == sha256:
+        conn.execute("UPDATE processed SET mtime = ? WHERE source = ?",
+                     (stat.st_mtime, img_path))
+        conn.commit()
+        return True
+    return False
+
+# What the manifest records as the way a crop was made: the demosaic profile,
+# plus "+locate" for chip_crop crops.
+def crop_profile(demosaic, locate):
+    return demosaic + "+locate" if locate else demosaic
+
+def record_ingested(conn, res, newsize, demosaic):
+    stat = os.stat(res["image"])
+    conn.execute("INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (res["image"], stat.st_size, stat.st_mtime, file_hash(res["image"]),
+                  newsize, demosaic, res["full"], res["crop"], time.time()))
+    conn.commit()
+
+# Ingest every image in src into full_dir (full-size PNG) and crop_dir (center
+# crop of size x size). Output directories are created if they don't exist.
+# See ingest_image for the full-size options; with full="skip" full_dir may be
+# None.
+# With workers > 1 the per-file work is spread over a pool of processes;
+# executor.map hands results back in the same order the files were submitted,
+# and each file goes through the same ingest_image call as the serial path, so
+# the saved images are identical either way.
+# With a manifest (path to a SQLite file, created if needed) only images that
+# are new or have changed since they were last ingested with the same settings
+# are processed, and each one is recorded as soon as it is done.
+# fmt and compress_level pick the output format, see save_image. With
+# workers == 1 and writers > 0, encoding runs on that many threads and overlaps
+# with decoding the next images; at most writers + 1 images are held in memory.
+# With a store directory every crop is also written to a new shard of the crop
+# store (see new_store_shard). locate crops around the chip, see chip_crop.
+# Returns one dict per processed file, see ingest_image.
+def ingest(src, full_dir, crop_dir, size=1900, workers=1, full="save",
+           demosaic="ahd", manifest=None, fmt="png", compress_level=6,
+           writers=0, store=None, locate=False):
+    if os.path.exists(src) == False:
+        raise TypeError("The path provided does not exist. Do you need to provide a"
+                        " leading '/' (on Windows, you need to provide 'C:\\' instead).")
+    if full != "skip":
+        os.makedirs(full_dir, exist_ok=True)
+    os.makedirs(crop_dir, exist_ok=True)
+
+    # Names and locations of images for reading.
+    rawimgs = sorted(os.listdir(src))
+    img_paths = list()
+    full_paths = list()
+    crop_paths = list()
+
+    conn = open_manifest(manifest) if manifest else None
+    profile = crop_profile(demosaic, locate)
+    skipped = 0
+
+    for img_name in rawimgs:
+        new_name = output_name(img_name, fmt)
+        img_path = os.path.join(src, img_name)
+        full_path = os.path.join(full_dir, new_name) if full_dir else None
+        crop_path = os.path.join(crop_dir, new_name)
+        if conn and already_ingested(conn, img_path, full_path, crop_path, size,
+                                     full, profile):
+            skipped += 1
+            continue
+        img_paths.append(img_path)
+        full_paths.append(full_path)
+        crop_paths.append(crop_path)
+
+    if conn:
+        print("Skipping {} images that were already processed.".format(skipped))
+
+    sizes = [size] * len(img_paths)
+    fulls = [full] * len(img_paths)
+    demosaics = [demosaic] * len(img_paths)
+    fmts = [fmt] * len(img_paths)
+    compress_levels = [compress_level] * len(img_paths)
+    locates = [locate] * len(img_paths)
+    if store and img_paths:
+        shard_path = new_store_shard(store, len(img_paths), size)
+        store_rows = [(shard_path, row) for row in range(len(img_paths))]
+    else:
+        store_rows = [None] * len(img_paths)
+    results = list()
+
+    def done(res):
+        results.append(res)
+        if conn:
+            record_ingested(conn, res, size, profile)
+        if store_rows[0] is not None:
+            record_stored(store, res)
+
+    try:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for res in executor.map(ingest_image, img_paths, full_paths,
+                                        crop_paths, sizes, fulls, demosaics,
+                                        fmts, compress_levels, store_rows,
+                                        locates):
+                    done(res)
+        elif writers > 0:
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=writers) as writer:
+                for args in zip(img_paths, full_paths, crop_paths, sizes, fulls,
+                                demosaics, fmts, compress_levels, store_rows,
+                                locates):
+                    pending.append(ingest_image(*args, writer=writer))
+                    if len(pending) > writers:
+                        done(finish_writes(pending.popleft()))
+                while pending:
+                    done(finish_writes(pending.popleft()))
+        else:
+            for res in map(ingest_image, img_paths, full_paths, crop_paths,
+                           sizes, fulls, demosaics, fmts, compress_levels,
+                           store_rows, locates):
+                done(res)
+    finally:
+        if conn:
+            conn.close()
+    return results
+
+# Long-running version of ingest. Polls src every interval seconds for DNG and
+# JPG captures and ingests each one once its size and mtime have stayed the same
+# for settle seconds, i.e. once the camera or copy has finished writing it. If
+# the watchdog package is installed its inotify (or platform equivalent)
+# observer wakes the loop as soon as something changes in src; polling still
+# runs as a fallback. Work goes to a pool of worker processes, with at most
+# queue_size images waiting or in progress; while the queue is full no new
+# files are picked up. Results are passed to on_result (print by default) as
+# they finish. Runs until interrupted (Ctrl-C). The manifest (see ingest) makes
+# a restarted watcher skip what it has already done.
+def watch(src, full_dir, crop_dir, size=1900, workers=1, full="save",
+          demosaic="ahd", manifest=None, interval=2.0, settle=2.0,
+          queue_size=None, on_result=print, fmt="png", compress_level=6,
+          locate=False):
+    if os.path.exists(src) == False:
+        raise TypeError("The path provided does not exist. Do you need to provide a"
+                        " leading '/' (on Windows, you need to provide 'C:\\' instead).")
+    if full != "skip":
+        os.makedirs(full_dir, exist_ok=True)
+    os.makedirs(crop_dir, exist_ok=True)
+    queue_size = queue_size or 2 * workers
+
+    changed = threading.Event()
+    observer = None
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        print("watchdog is not installed; polling {} every {} s.".format(src, interval))
+    else:
+        handler = FileSystemEventHandler()
+        handler.on_any_event = lambda event: changed.set()
+        observer = Observer()
+        observer.schedule(handler, src)
+        observer.start()
+
+    conn = open_manifest(manifest) if manifest else None
+    profile = crop_profile(demosaic, locate)
+    # Last (size, mtime) seen for files that aren't ready yet, and when it was
+    # first seen.
+    pending = dict()
+    # (size, mtime) of files that are queued or done, so they aren't picked up
+    # again unless they change.
+    seen = dict()
+    futures = dict()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                for future in [f for f in futures if f.done()]:
+                    img_path = futures.pop(future)
+                    try:
+                        res = future.result()
+                    except Exception as err:
+                        print("Could not ingest {}: {}".format(img_path, err))
+                        continue
+                    if conn:
+                        record_ingested(conn, res, size, profile)
+                    on_result(res)
+
+                now = time.monotonic()
+                for img_name in sorted(os.listdir(src)):
+                    if len(futures) >= queue_size:
+                        break
+                    if capture_type(img_name) not in ('dng', 'jpg'):
+                        continue
+                    img_path = os.path.join(src, img_name)
+                    try:
+                        stat = os.stat(img_path)
+                    except FileNotFoundError:
+                        continue
+                    sig = (stat.st_size, stat.st_mtime)
+                    if seen.get(img_path) == sig:
+                        continue
+                    if img_path not in pending or pending[img_path][0] != sig:
+                        pending[img_path] = (sig, now)
+                        continue
+                    if now - pending[img_path][1] < settle:
+                        continue
+                    del pending[img_path]
+                    seen[img_path] = sig
+                    new_name = output_name(img_name, fmt)
+                    full_path = os.path.join(full_dir, new_name) if full_dir else None
+                    crop_path = os.path.join(crop_dir, new_name)
+                    if conn and already_ingested(conn, img_path, full_path, crop_path,
+                                                 size, full, profile):
+                        continue
+                    futures[executor.submit(ingest_image, img_path, full_path,
+                                            crop_path, size, full, demosaic, fmt,
+                                            compress_level, None, locate)] = img_path
+
+                if futures:
+                    wait(futures, timeout=min(interval, settle), return_when=FIRST_COMPLETED)
+                else:
+                    changed.wait(min(interval, settle) if pending else interval)
+                    changed.clear()
+    except KeyboardInterrupt:
+        print("Stopped watching {}.".format(src))
+    finally:
+        if observer:
+            observer.stop()
+            observer.join()
+        if conn:
+            conn.close()
+
+# Encode the crops of the first n_images images in src with each output format
+# (PNG at several compression levels) and report, per format, the average encode
+# time, throughput in MB/s of raw pixels and size on disk.
+def benchmark_formats(src, size=1900, n_images=3, demosaic="ahd",
+                      png_levels=(0, 1, 6, 9)):
+    crops = list()
+    for img_name in sorted(os.listdir(src))[:n_images]:
+        img_path = os.path.join(src, img_name)
+        if capture_type(img_path) == 'dng':
+            crops.append(decode_crop(img_path, size, demosaic)[1])
+        else:
+            crops.append(centercrop(load_image(img_path), size))
+    options = [("png", level) for level in png_levels]
+    options += [("tiff", None), ("npy", None), ("webp", None)]
+    report = list()
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt, level in options:
+            seconds = 0.0
+            nbytes = 0
+            file_bytes = 0
+            for i, crop in enumerate(crops):
+                path = os.path.join(tmp, str(i) + OUTPUT_FORMATS[fmt])
+                start = time.perf_counter()
+                if level is None:
+                    save_image(crop, path, fmt)
+                else:
+                    save_image(crop, path, fmt, level)
+                seconds += time.perf_counter() - start
+                nbytes += np.asarray(crop).nbytes
+                file_bytes += os.path.getsize(path)
+            report.append(dict(format=fmt, compress_level=level,
+                               seconds=seconds / len(crops),
+                               mb_per_s=nbytes / 1e6 / seconds,
+                               file_mb=file_bytes / 1e6 / len(crops)))
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert RAW (DNG) and JPG captures to PNG, saving a"
+                    " full-size copy and a center crop of each.")
+    parser.add_argument("src", help="directory with the images awaiting analysis")
+    parser.add_argument("full_dir", nargs="?",
+                        help="directory for saving full-size images (left out with"
+                             " --full skip: src crop_dir)")
+    parser.add_argument("crop_dir", nargs="?",
+                        help="directory for saving cropped images")
+    parser.add_argument("--size", type=int, default=1900,
+                        help="side of the square center crop, in pixels")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes; 1 runs serially")
+    parser.add_argument("--full", choices=["save", "async", "skip"], default="save",
+                        help="write full-size images in line, on a background"
+                             " thread while the crop is encoded, or not at all")
+    parser.add_argument("--demosaic", choices=list(DEMOSAIC_PROFILES), default="ahd",
+                        help="how DNGs are decoded: full AHD, full bilinear, half"
+                             " size, or only the crop region of the sensor")
+    parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default="png",
+                        help="file format of the saved images")
+    parser.add_argument("--compress-level", type=int, default=6,
+                        help="PNG compression level, 0 (fastest) to 9 (smallest)")
+    parser.add_argument("--writers", type=int, default=0,
+                        help="with --workers 1, threads that encode images while the"
+                             " next ones are decoded; 0 encodes in line")
+    parser.add_argument("--store",
+                        help="directory of a crop store; every crop is also written"
+                             " to one memory-mappable uint8 array there")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="don't save anything; report encode speed and file size"
+                             " of each output format for a few crops from src")
+    parser.add_argument("--locate", action="store_true",
+                        help="find the chip and crop around it, turned square to the"
+                             " picture, instead of taking the center crop")
+    parser.add_argument("--manifest",
+                        help="SQLite file recording processed images; images already"
+                             " in it with the same settings are skipped")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and ingest new captures as they land in src")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="with --watch, seconds between scans of src")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="with --watch, seconds a file must stay unchanged"
+                             " before it is ingested")
+    parser.add_argument("--queue", type=int,
+                        help="with --watch, most images waiting or in progress at"
+                             " once (default twice --workers)")
+    parser.add_argument("--compare", action="store_true",
+                        help="don't save anything; report how the --demosaic crops"
+                             " differ from full AHD ones for the DNGs in src")
+    args = parser.parse_args(argv)
+    # With --full skip no full-size images are written, so "src crop_dir" is
+    # enough; the second positional is then the crop directory.
+    if args.full == "skip" and args.crop_dir is None:
+        args.full_dir, args.crop_dir = None, args.full_dir
+    if not (args.compare or args.benchmark) and args.crop_dir is None:
+        parser.error("crop_dir is required unless --compare or --benchmark is given"
+                     if args.full == "skip" else
+                     "full_dir and crop_dir are required (only crop_dir with --full"
+                     " skip) unless --compare or --benchmark is given")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.compare:
+        for res in compare_demosaic(args.src, args.size, args.demosaic):
+            print("{image}: {demosaic} vs ahd mean |diff| {mean_abs_diff:.2f},"
+                  " max |diff| {max_abs_diff:.0f}, quadrant green |diff|"
+                  " {green_diff:.2f}; {seconds:.2f} s vs {ahd_seconds:.2f} s"
+                  " ({speedup:.1f}x)".format(**res))
+        sys.exit()
 
-for i in range(len(post_im_list)):
-    cencrop_lis.append(centercrop(post_im_list[i], 1900))
+    if args.benchmark:
+        for res in benchmark_formats(args.src, args.size, demosaic=args.demosaic):
+            print("{:>4} {:>4}: {:.3f} s/image, {:.1f} MB/s, {:.2f} MB/image".format(
+                res["format"], "" if res["compress_level"] is None
+                else res["compress_level"], res["seconds"], res["mb_per_s"],
+                res["file_mb"]))
+        sys.exit()
 
-# For saving the cropped images.
-newnamelis = list()
-crop_names_path = list()
+    if args.watch:
+        watch(args.src, args.full_dir, args.crop_dir, args.size, args.workers,
+              args.full, args.demosaic, args.manifest, args.interval, args.settle,
+              args.queue,
+              fmt=args.format, compress_level=args.compress_level,
+              locate=args.locate,
+              on_result=lambda res: print("{} -> {} and {} in {:.2f} s".format(
+                  res["image"], res["full"], res["crop"], res["seconds"])))
+        sys.exit()
 
-# Save cropped images as PNG full-size. 
-crop_save = input("Please provide a directory path for saving cropped images.\n")
+    start = time.perf_counter()
+    results = ingest(args.src, args.full_dir, args.crop_dir, args.size,
+                     args.workers, args.full, args.demosaic, args.manifest,
+                     args.format, args.compress_level, args.writers, args.store,
+                     args.locate)
+    elapsed = time.perf_counter() - start
 
-if os.path.exists(crop_save) == False:
-    new_dir_response = input("Directory does not exist. Should it be created? [Yes or No] If so, we will use {}\n".format(crop_save)) or "No"
-    if new_dir_response == "Yes":
-      os.mkdir(crop_save)
+    for res in results:
+        print("{} -> {} and {} in {:.2f} s".format(res["image"], res["full"],
+                                                   res["crop"], res["seconds"]))
 
-for i in range(len(rawimgs)):
-    newnamelis.append(rawimgs[i].replace("dng","png"))
-    crop_names_path.append(os.path.join(crop_save, newnamelis[i]))
-    cencrop_lis[i].save(crop_names_path[i])
+    print("complete: {} images in {:.2f} s ({:.2f} images/s)".format(
+        len(results), elapsed, len(results) / elapsed if elapsed else 0.0))
 
-print("complete")
 # Write out a bunch of plt. statements because I don't know how to call plt in a loop.
 #for i in range(len(post_im_list)):
 #    colus = int(len(post_im_list)/6)
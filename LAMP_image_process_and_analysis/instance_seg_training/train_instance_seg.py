@@ -12,6 +12,8 @@ import matplotlib.image as mpimg
 from git.repo.base import Repo
 import shutil
 
+from crop_store import stored_crops
+
 # Update this path to the folder with images and masks
 dir_in = input('Provide the root path to the image and mask.\nNote for Windows, use \'\\\'\
  as the separator and put \'\' around the path.\n')
@@ -26,9 +28,14 @@ imag_dir = input('Provide name of folder with images.\nThey should\
  For Windows, use \'\\\'\
  as the separator and put \'\' around the input.\n')
 
+# Optional. A crop store written by the image prep app (ingest --store) that
+# holds the same images, so they are not decoded again every epoch.
+store_dir = input('Provide the path to a crop store with the images, or leave\
+ it empty to read the image files.\n') or None
+
 
 class sensor_image(torch.utils.data.Dataset):
-    def __init__(self, root, transforms=None, target_transform=None):
+    def __init__(self, root, transforms=None, target_transform=None, store=None):
         self.root = root
         self.transforms = transforms
         self.target_transform = target_transform
@@ -36,12 +43,19 @@ class sensor_image(torch.utils.data.Dataset):
         # ensure that they are aligned
         self.imgs = list(sorted(os.listdir(os.path.join(root, imag_dir))))
         self.masks = list(sorted(os.listdir(os.path.join(root, mask_dir))))
+        # with a crop store the images are read from it, by file name
+        self.store = stored_crops(store, self.imgs) if store is not None else None
         
     def __getitem__(self, idx):
         # load images ad masks
         img_path = os.path.join(self.root, imag_dir, self.imgs[idx])
         mask_path = os.path.join(self.root, mask_dir, self.masks[idx])
-        img = Image.open(img_path).convert("RGB")
+        if self.store is not None:
+            # [H, W, 3] view of the stored crop; ToTensor takes a uint8 array
+            # like this the same way as a PIL image
+            img = self.store.crop(idx).numpy().transpose(1, 2, 0)
+        else:
+            img = Image.open(img_path).convert("RGB")
         # note that we haven't converted the mask to RGB,
         # because each color corresponds to a different instance
         # with 0 being background
@@ -139,9 +153,12 @@ from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 num_classes = 5
 
 
-def get_instance_segmentation_model(num_classes):
+# Any keyword arguments go to the model builder, to train with other settings
+# than the COCO ones, e.g. the "lamp_chip" profile in the segmentation app:
+# get_instance_segmentation_model(num_classes, min_size=640, max_size=640)
+def get_instance_segmentation_model(num_classes, **kwargs):
     # load an instance segmentation model pre-trained on COCO
-    model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights=True)
+    model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights=True, **kwargs)
     
     # get the number of input features for the classifier
     in_features = model.roi_heads.box_predictor.cls_score.in_features
@@ -196,8 +213,8 @@ def get_instance_segmentation_model(num_classes):
 ###End Optional
 
 # use our dataset and defined transformations
-dataset = sensor_image(dir_in, get_transform(train=True))
-dataset_test = sensor_image(dir_in, get_transform(train=False))
+dataset = sensor_image(dir_in, get_transform(train=True), store=store_dir)
+dataset_test = sensor_image(dir_in, get_transform(train=False), store=store_dir)
 
 # split the dataset in train and test set
 torch.manual_seed(1)
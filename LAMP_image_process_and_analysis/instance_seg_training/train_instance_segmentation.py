@@ -213,9 +213,12 @@ from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 
 num_classes = 5
       
-def get_instance_segmentation_model(num_classes):
+# Any keyword arguments go to the model builder, to train with other settings
+# than the COCO ones, e.g. the "lamp_chip" profile in the segmentation app:
+# get_instance_segmentation_model(num_classes, min_size=640, max_size=640)
+def get_instance_segmentation_model(num_classes, **kwargs):
     # load an instance segmentation model pre-trained on COCO
-    model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights=True)
+    model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights=True, **kwargs)
 
     # get the number of input features for the classifier
     in_features = model.roi_heads.box_predictor.cls_score.in_features
@@ -1,6 +1,9 @@
 import copy
+import pickle
 import torch
 from torchvision.models.detection import _utils
+from torchvision.models.detection.roi_heads import RoIHeads, crop_masks_to_boxes, expand_boxes, expand_masks, \
+    mask_pixel_stats, paste_mask_in_image, paste_masks_in_image
 from torchvision.models.detection.transform import GeneralizedRCNNTransform
 import pytest
 from torchvision.models.detection import backbone_utils
@@ -68,6 +71,250 @@ class TestModelsDetectionUtils:
         with pytest.raises(TypeError):
             out = transform(image, targets)  # noqa: F841
 
+    def _paste_masks_loop(self, masks, boxes, img_shape):
+        # the per-detection pasting paste_masks_in_image replaced
+        masks, scale = expand_masks(masks, padding=1)
+        boxes = expand_boxes(boxes, scale).to(dtype=torch.int64)
+        return torch.stack([paste_mask_in_image(m[0], b, img_shape[0], img_shape[1])
+                            for m, b in zip(masks, boxes)])[:, None]
+
+    def _random_masks_and_boxes(self, n, img_shape):
+        torch.manual_seed(0)
+        masks = torch.rand(n, 1, 28, 28)
+        # some boxes are partly outside the image, and one is tiny
+        xy = torch.rand(n, 2) * torch.tensor([img_shape[1], img_shape[0]]) - 10
+        wh = torch.rand(n, 2) * 80 + 12
+        xy[0], wh[0] = 5., 0.5
+        return masks, torch.cat([xy, xy + wh], dim=1)
+
+    @pytest.mark.parametrize('chunk_size', [1, 4, 32])
+    def test_paste_masks_in_image(self, chunk_size):
+        img_shape = (120, 97)
+        masks, boxes = self._random_masks_and_boxes(10, img_shape)
+        expected = self._paste_masks_loop(masks, boxes, img_shape)
+        out = paste_masks_in_image(masks, boxes, img_shape, chunk_size=chunk_size)
+        assert out.shape == (10, 1) + img_shape
+        torch.testing.assert_close(out, expected, rtol=0, atol=1e-5)
+
+    def test_paste_masks_in_image_outside(self):
+        masks = torch.rand(2, 1, 28, 28)
+        boxes = torch.tensor([[105., 10., 130., 40.], [10., 10., 30., 40.]])
+        out = paste_masks_in_image(masks, boxes, (120, 97))
+        assert out[0].sum() == 0
+        assert out[1].sum() > 0
+
+    def test_paste_masks_in_image_formats(self):
+        img_shape = (120, 97)
+        masks, boxes = self._random_masks_and_boxes(10, img_shape)
+        probs = paste_masks_in_image(masks, boxes, img_shape)
+
+        out = paste_masks_in_image(masks, boxes, img_shape, mask_format="uint8")
+        assert out.dtype == torch.uint8
+        torch.testing.assert_close(out.float() / 255, probs, rtol=0, atol=0.5 / 255 + 1e-6)
+
+        out = paste_masks_in_image(masks, boxes, img_shape, mask_format="binary", mask_threshold=0.4)
+        assert_equal(out, probs > 0.4)
+
+        out = paste_masks_in_image(masks, boxes, img_shape, mask_format="packed")
+        assert out.shape == (10, 1, 120, 13)
+        bits = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+        unpacked = (out[..., None] & bits).ne(0).flatten(-2)[..., :img_shape[1]]
+        assert_equal(unpacked, probs > 0.5)
+
+        with pytest.raises(ValueError):
+            paste_masks_in_image(masks, boxes, img_shape, mask_format="half")
+
+    @pytest.mark.parametrize('mask_format, shape, dtype', [
+        ("float", (0, 1, 30, 20), torch.float32),
+        ("binary", (0, 1, 30, 20), torch.bool),
+        ("packed", (0, 1, 30, 3), torch.uint8),
+    ])
+    def test_paste_masks_in_image_empty(self, mask_format, shape, dtype):
+        out = paste_masks_in_image(torch.rand(0, 1, 28, 28), torch.rand(0, 4), (30, 20), mask_format=mask_format)
+        assert out.shape == shape
+        assert out.dtype == dtype
+
+    def test_transform_mask_format(self):
+        transform = GeneralizedRCNNTransform(300, 500, torch.zeros(3), torch.ones(3), mask_format="binary").eval()
+        result = [{'boxes': torch.tensor([[10., 10., 100., 80.]]), 'masks': torch.rand(1, 1, 28, 28)}]
+        result = transform.postprocess(result, [(300, 400)], [(150, 200)])
+        assert result[0]['masks'].shape == (1, 1, 150, 200)
+        assert result[0]['masks'].dtype == torch.bool
+
+    def test_transform_unpickle_old_mask_format(self):
+        # as pickled before mask_format was added
+        transform = GeneralizedRCNNTransform(300, 500, torch.zeros(3), torch.ones(3)).eval()
+        del transform.mask_format
+        transform = pickle.loads(pickle.dumps(transform))
+        boxes, masks = torch.tensor([[10., 10., 100., 80.]]), torch.rand(1, 1, 28, 28)
+        result = transform.postprocess([{'boxes': boxes, 'masks': masks}], [(150, 200)], [(150, 200)])
+        assert_equal(result[0]['masks'], paste_masks_in_image(masks, boxes, (150, 200)))
+
+    def test_crop_masks_to_boxes(self):
+        img_shape = (120, 97)
+        masks, boxes = self._random_masks_and_boxes(10, img_shape)
+        boxes = torch.cat([boxes, torch.tensor([[105., 10., 130., 40.]])])
+        masks = torch.cat([masks, torch.rand(1, 1, 28, 28)])
+        expected = paste_masks_in_image(masks, boxes, img_shape)
+        out, mask_boxes = crop_masks_to_boxes(masks, boxes, img_shape)
+        assert mask_boxes.dtype == torch.int64
+        sizes = mask_boxes[:, 2:] - mask_boxes[:, :2]
+        assert out.shape == (11, 1, sizes[:, 1].max(), sizes[:, 0].max())
+        assert sizes[-1].prod() == 0
+        pasted = torch.zeros_like(expected)
+        for mask, pasted_mask, (x_0, y_0, x_1, y_1) in zip(out, pasted, mask_boxes.tolist()):
+            pasted_mask[:, y_0:y_1, x_0:x_1] = mask[:, :y_1 - y_0, :x_1 - x_0]
+            assert mask[:, y_1 - y_0:].sum() == 0 and mask[:, :, x_1 - x_0:].sum() == 0
+        assert_equal(pasted, expected)
+
+    def test_mask_pixel_stats(self):
+        img_shape = (120, 97)
+        masks, boxes = self._random_masks_and_boxes(10, img_shape)
+        image = torch.randint(0, 256, (3,) + img_shape, dtype=torch.uint8)
+        dense = paste_masks_in_image(masks, boxes, img_shape)[:, 0] > 0.5
+
+        stats = mask_pixel_stats(image, {"boxes": boxes, "masks": masks}, "roi")
+        assert_equal(stats["pixels"], dense.sum(dim=(1, 2)))
+        for k, keep in enumerate(dense):
+            values = image[:, keep]
+            assert_equal(stats["sum"][k], values.sum(dim=1, dtype=torch.float64))
+            assert_equal(stats["histogram"][k], torch.stack([torch.bincount(v, minlength=256) for v in values]))
+        assert_equal(stats["mean"], stats["sum"] / stats["pixels"][:, None])
+
+        binary = paste_masks_in_image(masks, boxes, img_shape, mask_format="binary")
+        dense_stats = mask_pixel_stats(image, {"masks": binary}, "binary")
+        for key in stats:
+            assert_equal(dense_stats[key], stats[key])
+
+        float_stats = mask_pixel_stats(image.float(), {"boxes": boxes, "masks": masks}, "roi")
+        assert "histogram" not in float_stats
+        torch.testing.assert_close(float_stats["mean"], stats["mean"])
+
+        empty = mask_pixel_stats(image, {"boxes": torch.tensor([[10., 10., 20., 20.]]),
+                                         "masks": torch.zeros(1, 1, 28, 28)}, "roi")
+        assert empty["pixels"][0] == 0
+        assert empty["mean"].isnan().all()
+
+        with pytest.raises(ValueError):
+            mask_pixel_stats(image, {"masks": binary}, "packed")
+
+    @pytest.mark.parametrize('mask_format', ["roi", "cropped"])
+    def test_transform_box_mask_formats(self, mask_format):
+        transform = GeneralizedRCNNTransform(300, 500, torch.zeros(3), torch.ones(3), mask_format=mask_format).eval()
+        masks = torch.rand(2, 1, 28, 28)
+        result = [{'boxes': torch.tensor([[10., 10., 100., 80.], [0., 0., 50., 50.]]), 'masks': masks.clone()}]
+        result = transform.postprocess(result, [(300, 400)], [(150, 200)])
+        if mask_format == "roi":
+            assert_equal(result[0]['masks'], masks)
+            assert 'mask_boxes' not in result[0]
+        else:
+            cropped, mask_boxes = crop_masks_to_boxes(masks, result[0]['boxes'], (150, 200))
+            assert result[0]['masks'].dtype == torch.uint8
+            assert_equal(result[0]['masks'], cropped.mul(255).round().to(torch.uint8))
+            assert_equal(result[0]['mask_boxes'], mask_boxes)
+
+        image = torch.randint(0, 256, (3, 150, 200), dtype=torch.uint8)
+        stats = mask_pixel_stats(image, result[0], mask_format)
+        assert stats["pixels"].shape == (2,)
+        assert stats["histogram"].shape == (2, 3, 256)
+
+    @pytest.mark.parametrize('allowed_labels, detections_per_class, expected', [
+        (None, None, [1, 2, 1, 3, 1, 2]),
+        ([1, 3], None, [1, 1, 3, 1]),
+        (None, 1, [1, 2, 3]),
+        ([2, 3], 1, [2, 3]),
+        ([], None, []),
+    ])
+    def test_roi_heads_inference_filter(self, allowed_labels, detections_per_class, expected):
+        roi_heads = RoIHeads(None, None, None, 0.5, 0.5, 512, 0.25, None, 0.05, 0.5, 100)
+        # six apart boxes, each sure of its label, in falling order of score
+        labels = torch.tensor([1, 2, 1, 3, 1, 2])
+        class_logits = torch.full((6, 4), -10.)
+        class_logits[torch.arange(6), labels] = torch.linspace(10, 5, 6)
+        proposals = [torch.arange(6.)[:, None] * 20 + torch.tensor([0., 0., 10., 10.])]
+        box_regression = torch.zeros(6, 16)
+
+        boxes, scores, pred_labels = roi_heads.postprocess_detections(class_logits, box_regression, proposals,
+                                                                      [(200, 200)])
+        assert pred_labels[0].tolist() == [1, 2, 1, 3, 1, 2]
+
+        roi_heads.allowed_labels = allowed_labels
+        roi_heads.detections_per_class = detections_per_class
+        boxes, scores, pred_labels = roi_heads.postprocess_detections(class_logits, box_regression, proposals,
+                                                                      [(200, 200)])
+        assert pred_labels[0].tolist() == expected
+        assert boxes[0].shape == (len(expected), 4)
+        assert (scores[0][1:] <= scores[0][:-1]).all()
+
+    def test_roi_heads_unpickle_old(self):
+        # as pickled before allowed_labels and detections_per_class were added
+        roi_heads = RoIHeads(None, None, None, 0.5, 0.5, 512, 0.25, None, 0.05, 0.5, 100)
+        del roi_heads.allowed_labels, roi_heads.detections_per_class
+        roi_heads = pickle.loads(pickle.dumps(roi_heads))
+        class_logits = torch.tensor([[-10., 10., -10.], [-10., -10., 5.]])
+        proposals = [torch.tensor([[0., 0., 10., 10.], [20., 20., 30., 30.]])]
+        boxes, scores, pred_labels = roi_heads.postprocess_detections(class_logits, torch.zeros(2, 12), proposals,
+                                                                      [(200, 200)])
+        assert pred_labels[0].tolist() == [1, 2]
+
+    def _transform_images_one_by_one(self, transform, images):
+        images = [transform.resize(transform.normalize(image))[0] for image in images]
+        return transform.batch_images(images, transform.size_divisible), [tuple(i.shape[-2:]) for i in images]
+
+    @pytest.mark.parametrize('min_size, max_size, fixed_size, exact', [
+        (1600, 1600, None, True),
+        (333, 1000, None, True),
+        (500, 1000, (517, 333), True),
+        (800, 1333, None, False),
+        (600, 1000, None, False),
+    ])
+    @pytest.mark.parametrize('reuse_batch_buffer', [False, True])
+    def test_transform_same_size(self, min_size, max_size, fixed_size, exact, reuse_batch_buffer):
+        transform = GeneralizedRCNNTransform(min_size, max_size, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225],
+                                             fixed_size=fixed_size, reuse_batch_buffer=reuse_batch_buffer).eval()
+        shape = (3, 1600, 1600) if min_size in (800, 1600) else (3, 333, 517)
+        for _ in range(2):
+            images = [torch.rand(shape) for _ in range(3)]
+            image_list, targets = transform(images)
+        expected, image_sizes = self._transform_images_one_by_one(transform, images)
+        assert targets is None
+        assert image_list.image_sizes == image_sizes
+        if exact:
+            assert_equal(image_list.tensors, expected)
+        else:
+            torch.testing.assert_close(image_list.tensors, expected)
+        assert (transform._batch_buffer is image_list.tensors) == reuse_batch_buffer
+
+    def test_transform_reused_buffer_padding(self):
+        transform = GeneralizedRCNNTransform(300, 500, torch.zeros(3), torch.ones(3), reuse_batch_buffer=True).eval()
+        first = transform([torch.rand(3, 300, 320), torch.rand(3, 300, 320)])[0].tensors
+        images = [torch.rand(3, 290, 300), torch.rand(3, 290, 300)]
+        image_list = transform(images)[0]
+        assert image_list.tensors is first
+        expected, image_sizes = self._transform_images_one_by_one(transform, images)
+        assert image_list.image_sizes == image_sizes
+        torch.testing.assert_close(image_list.tensors, expected)
+
+    def test_transform_mixed_sizes(self):
+        transform = GeneralizedRCNNTransform(300, 500, torch.zeros(3), torch.ones(3), reuse_batch_buffer=True).eval()
+        images = [torch.rand(3, 300, 320), torch.rand(3, 200, 300)]
+        image_list = transform(images)[0]
+        expected, image_sizes = self._transform_images_one_by_one(transform, images)
+        assert image_list.image_sizes == image_sizes
+        assert_equal(image_list.tensors, expected)
+        assert transform._batch_buffer is None
+
+    def test_transform_unpickle_old(self):
+        # as pickled before reuse_batch_buffer was added
+        transform = GeneralizedRCNNTransform(300, 500, torch.zeros(3), torch.ones(3)).eval()
+        del transform.reuse_batch_buffer, transform._batch_buffer
+        transform = pickle.loads(pickle.dumps(transform))
+        images = [torch.rand(3, 300, 320), torch.rand(3, 300, 320)]
+        image_list = transform(images)[0]
+        expected, image_sizes = self._transform_images_one_by_one(transform, images)
+        assert_equal(image_list.tensors, expected)
+        assert transform._batch_buffer is None
+
 
 if __name__ == '__main__':
     pytest.main([__file__])
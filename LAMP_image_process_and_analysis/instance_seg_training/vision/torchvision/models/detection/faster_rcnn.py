@@ -97,6 +97,14 @@ class FasterRCNN(GeneralizedRCNN):
             of the classification head
         bbox_reg_weights (Tuple[float, float, float, float]): weights for the encoding/decoding of the
             bounding boxes
+        box_allowed_labels (List[int]): during inference, only return detections of these labels
+            (default: all)
+        box_detections_per_class (int): during inference, maximum number of detections per image of
+            each class (default: no maximum)
+
+    box_score_thresh, box_detections_per_img, box_allowed_labels and box_detections_per_class filter the
+    detections before the mask and keypoint heads run. They are attributes of roi_heads (score_thresh,
+    detections_per_img, allowed_labels and detections_per_class), which can be changed between calls.
 
     Example::
 
@@ -158,7 +166,8 @@ class FasterRCNN(GeneralizedRCNN):
                  box_score_thresh=0.05, box_nms_thresh=0.5, box_detections_per_img=100,
                  box_fg_iou_thresh=0.5, box_bg_iou_thresh=0.5,
                  box_batch_size_per_image=512, box_positive_fraction=0.25,
-                 bbox_reg_weights=None):
+                 bbox_reg_weights=None,
+                 box_allowed_labels=None, box_detections_per_class=None):
 
         if not hasattr(backbone, "out_channels"):
             raise ValueError(
@@ -225,7 +234,8 @@ class FasterRCNN(GeneralizedRCNN):
             box_fg_iou_thresh, box_bg_iou_thresh,
             box_batch_size_per_image, box_positive_fraction,
             bbox_reg_weights,
-            box_score_thresh, box_nms_thresh, box_detections_per_img)
+            box_score_thresh, box_nms_thresh, box_detections_per_img,
+            allowed_labels=box_allowed_labels, detections_per_class=box_detections_per_class)
 
         if image_mean is None:
             image_mean = [0.485, 0.456, 0.406]
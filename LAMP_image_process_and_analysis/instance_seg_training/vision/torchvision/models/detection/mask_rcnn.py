@@ -45,6 +45,12 @@ class MaskRCNN(FasterRCNN):
           obtain the final segmentation masks, the soft masks can be thresholded, generally
           with a value of 0.5 (mask >= 0.5)
 
+    With a mask_format other than "float", the masks are returned in another form (see
+    GeneralizedRCNNTransform): "uint8", "binary" or "packed" image-sized masks, or, without making
+    image-sized masks, the mask head's probabilities for each box ("roi") or uint8 masks cropped
+    to their boxes ("cropped", with the pixel boxes they cover as mask_boxes (Int64Tensor[N, 4])).
+    It can be changed between calls with model.transform.mask_format.
+
     Args:
         backbone (nn.Module): the network used to compute the features for the model.
             It should contain a out_channels attribute, which indicates the number of output
@@ -96,11 +102,17 @@ class MaskRCNN(FasterRCNN):
             of the classification head
         bbox_reg_weights (Tuple[float, float, float, float]): weights for the encoding/decoding of the
             bounding boxes
+        box_allowed_labels (List[int]): during inference, only return detections of these labels
+            (default: all)
+        box_detections_per_class (int): during inference, maximum number of detections per image of
+            each class (default: no maximum)
         mask_roi_pool (MultiScaleRoIAlign): the module which crops and resizes the feature maps in
              the locations indicated by the bounding boxes, which will be used for the mask head.
         mask_head (nn.Module): module that takes the cropped feature maps as input
         mask_predictor (nn.Module): module that takes the output of the mask_head and returns the
             segmentation mask logits
+        mask_format (str): form of the masks returned during inference: "float", "uint8", "binary",
+            "packed", "roi" or "cropped"
 
     Example::
 
@@ -168,7 +180,9 @@ class MaskRCNN(FasterRCNN):
                  box_batch_size_per_image=512, box_positive_fraction=0.25,
                  bbox_reg_weights=None,
                  # Mask parameters
-                 mask_roi_pool=None, mask_head=None, mask_predictor=None):
+                 mask_roi_pool=None, mask_head=None, mask_predictor=None,
+                 mask_format="float",
+                 box_allowed_labels=None, box_detections_per_class=None):
 
         assert isinstance(mask_roi_pool, (MultiScaleRoIAlign, type(None)))
 
@@ -213,11 +227,13 @@ class MaskRCNN(FasterRCNN):
             box_score_thresh, box_nms_thresh, box_detections_per_img,
             box_fg_iou_thresh, box_bg_iou_thresh,
             box_batch_size_per_image, box_positive_fraction,
-            bbox_reg_weights)
+            bbox_reg_weights,
+            box_allowed_labels=box_allowed_labels, box_detections_per_class=box_detections_per_class)
 
         self.roi_heads.mask_roi_pool = mask_roi_pool
         self.roi_heads.mask_head = mask_head
         self.roi_heads.mask_predictor = mask_predictor
+        self.transform.mask_format = mask_format
 
 
 class MaskRCNNHeads(nn.Sequential):
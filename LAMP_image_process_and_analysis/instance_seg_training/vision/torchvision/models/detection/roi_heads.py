@@ -461,8 +461,68 @@ def _onnx_paste_masks_in_image_loop(masks, boxes, im_h, im_w):
     return res_append
 
 
-def paste_masks_in_image(masks, boxes, img_shape, padding=1):
-    # type: (Tensor, Tensor, Tuple[int, int], int) -> Tensor
+def _resize_weights(size, M, length):
+    # type: (Tensor, int, int) -> Tensor
+    # Bilinear weights [N, length, M] that resize each of N mask rows of length M
+    # to `size` pixels, as F.interpolate(mode='bilinear', align_corners=False)
+    # does; the pixels past `size` get no weight.
+    rel = torch.arange(length, dtype=torch.float32, device=size.device)[None, :]
+    size = size[:, None].to(torch.float32)
+    inside = (rel < size).to(torch.float32)
+    src = (M / size * (rel + 0.5) - 0.5).clamp(min=0)
+    i0 = src.to(torch.int64).clamp(max=M - 1)
+    i1 = (i0 + 1).clamp(max=M - 1)
+    lambda1 = src - i0.to(torch.float32)
+    weights = torch.zeros((size.shape[0], length, M), dtype=torch.float32, device=size.device)
+    weights.scatter_add_(2, i0[:, :, None], ((1 - lambda1) * inside)[:, :, None])
+    weights.scatter_add_(2, i1[:, :, None], (lambda1 * inside)[:, :, None])
+    return weights
+
+
+def _resize_masks(masks, widths, heights):
+    # type: (Tensor, Tensor, Tensor) -> Tensor
+    # Resizes the [N, M, M] masks to their widths and heights in one go, as two
+    # batched matrix products with separable bilinear weights. Each one is at
+    # the top left of an [N, max(heights), max(widths)] tensor, padded with zeros.
+    M = masks.shape[-1]
+    rows = _resize_weights(heights, M, int(heights.max())).to(masks.dtype)
+    cols = _resize_weights(widths, M, int(widths.max())).to(masks.dtype)
+    return torch.bmm(torch.bmm(rows, masks), cols.transpose(1, 2))
+
+
+def _pack_bits(masks):
+    # type: (Tensor) -> Tensor
+    # Packs a bool [..., W] tensor into uint8 [..., ceil(W / 8)] along its last
+    # dimension, most significant bit first (as numpy.packbits).
+    pad = (8 - masks.shape[-1] % 8) % 8
+    masks = F.pad(masks.to(torch.uint8), (0, pad))
+    masks = masks.reshape(masks.shape[:-1] + (masks.shape[-1] // 8, 8))
+    packed = masks[..., 0] << 7
+    for bit in range(1, 8):
+        packed |= masks[..., bit] << (7 - bit)
+    return packed
+
+
+def paste_masks_in_image(masks, boxes, img_shape, padding=1, mask_format="float", mask_threshold=0.5,
+                         chunk_size=32):
+    # type: (Tensor, Tensor, Tuple[int, int], int, str, float, int) -> Tensor
+    """
+    Pastes the [N, 1, M, M] mask probabilities of the mask head into [N, 1, H, W]
+    image-sized masks, each resized bilinearly to its box.
+
+    The masks are resized `chunk_size` at a time, in a batch, and copied into the
+    result, which is allocated once in the format set by `mask_format`:
+
+        - "float": the probabilities, in the dtype of `masks`
+        - "uint8": the probabilities times 255, rounded
+        - "binary": bool masks of the probabilities above `mask_threshold`
+        - "packed": the binary masks with 8 pixels to each uint8 along their rows,
+          most significant bit first, so [N, 1, H, ceil(W / 8)]; numpy.unpackbits
+          (with axis=-1 and count=W) unpacks them
+    """
+    if mask_format not in ("float", "uint8", "binary", "packed"):
+        raise ValueError("mask_format should be 'float', 'uint8', 'binary' or 'packed', "
+                         "got {}".format(mask_format))
     masks, scale = expand_masks(masks, padding=padding)
     boxes = expand_boxes(boxes, scale).to(dtype=torch.int64)
     im_h, im_w = img_shape
@@ -471,15 +531,143 @@ def paste_masks_in_image(masks, boxes, img_shape, padding=1):
         return _onnx_paste_masks_in_image_loop(masks, boxes,
                                                torch.scalar_tensor(im_h, dtype=torch.int64),
                                                torch.scalar_tensor(im_w, dtype=torch.int64))[:, None]
-    res = [
-        paste_mask_in_image(m[0], b, im_h, im_w)
-        for m, b in zip(masks, boxes)
-    ]
-    if len(res) > 0:
-        ret = torch.stack(res, dim=0)[:, None]
+    N = masks.shape[0]
+    if mask_format == "float":
+        ret = masks.new_zeros((N, im_h, im_w))
+    elif mask_format == "uint8":
+        ret = masks.new_zeros((N, im_h, im_w), dtype=torch.uint8)
+    elif mask_format == "binary":
+        ret = masks.new_zeros((N, im_h, im_w), dtype=torch.bool)
+    else:
+        ret = masks.new_zeros((N, im_h, (im_w + 7) // 8), dtype=torch.uint8)
+    if N == 0:
+        return ret[:, None]
+
+    TO_REMOVE = 1
+    widths = (boxes[:, 2] - boxes[:, 0] + TO_REMOVE).clamp(min=1)
+    heights = (boxes[:, 3] - boxes[:, 1] + TO_REMOVE).clamp(min=1)
+    box_list: List[List[int]] = boxes.tolist()
+    for i in range(0, N, chunk_size):
+        j = min(i + chunk_size, N)
+        resized = _resize_masks(masks[i:j, 0], widths[i:j], heights[i:j])
+        if mask_format == "uint8":
+            resized = resized.mul_(255).round_().to(torch.uint8)
+        elif mask_format != "float":
+            resized = resized > mask_threshold
+        # packed masks are pasted a chunk at a time into full-size bool masks
+        if mask_format == "packed":
+            pasted = masks.new_zeros((j - i, im_h, im_w), dtype=torch.bool)
+        else:
+            pasted = ret[i:j]
+        for k in range(j - i):
+            box = box_list[i + k]
+            x_0 = max(box[0], 0)
+            x_1 = min(box[2] + 1, im_w)
+            y_0 = max(box[1], 0)
+            y_1 = min(box[3] + 1, im_h)
+            if x_0 < x_1 and y_0 < y_1:
+                pasted[k, y_0:y_1, x_0:x_1] = resized[k, (y_0 - box[1]):(y_1 - box[1]),
+                                                      (x_0 - box[0]):(x_1 - box[0])]
+        if mask_format == "packed":
+            ret[i:j] = _pack_bits(pasted)
+    return ret[:, None]
+
+
+def crop_masks_to_boxes(masks, boxes, img_shape, padding=1):
+    # type: (Tensor, Tensor, Tuple[int, int], int) -> Tuple[Tensor, Tensor]
+    """
+    Resizes the [N, 1, M, M] mask probabilities of the mask head to their boxes, as
+    paste_masks_in_image does, but keeps only the part of each box in the image
+    instead of pasting it into an image-sized mask.
+
+    Returns the masks, [N, 1, h, w] with each one at the top left and zeros past
+    it (h and w are the largest height and width), and the pixel boxes they cover,
+    [N, 4] int64 (x1, y1, x2, y2) with x2 and y2 exclusive: mask i is
+    masks[i, :, :y2 - y1, :x2 - x1] and covers image[:, y1:y2, x1:x2].
+    """
+    masks, scale = expand_masks(masks, padding=padding)
+    boxes = expand_boxes(boxes, scale).to(dtype=torch.int64)
+    im_h, im_w = img_shape
+
+    TO_REMOVE = 1
+    x_0 = boxes[:, 0].clamp(0, im_w)
+    y_0 = boxes[:, 1].clamp(0, im_h)
+    x_1 = torch.max((boxes[:, 2] + TO_REMOVE).clamp(0, im_w), x_0)
+    y_1 = torch.max((boxes[:, 3] + TO_REMOVE).clamp(0, im_h), y_0)
+    mask_boxes = torch.stack([x_0, y_0, x_1, y_1], dim=1)
+    N = masks.shape[0]
+    if N == 0:
+        return masks.new_zeros((0, 1, 0, 0)), mask_boxes
+
+    widths = (boxes[:, 2] - boxes[:, 0] + TO_REMOVE).clamp(min=1)
+    heights = (boxes[:, 3] - boxes[:, 1] + TO_REMOVE).clamp(min=1)
+    resized = _resize_masks(masks[:, 0], widths, heights)
+    sizes = mask_boxes[:, 2:] - mask_boxes[:, :2]
+    ret = masks.new_zeros((N, int(sizes[:, 1].max()), int(sizes[:, 0].max())))
+    box_list: List[List[int]] = boxes.tolist()
+    mask_box_list: List[List[int]] = mask_boxes.tolist()
+    for k in range(N):
+        box = box_list[k]
+        mask_box = mask_box_list[k]
+        ret[k, :mask_box[3] - mask_box[1], :mask_box[2] - mask_box[0]] = resized[
+            k, (mask_box[1] - box[1]):(mask_box[3] - box[1]), (mask_box[0] - box[0]):(mask_box[2] - box[0])
+        ]
+    return ret[:, None], mask_boxes
+
+
+def mask_pixel_stats(image, prediction, mask_format="float", mask_threshold=0.5):
+    # type: (Tensor, Dict[str, Tensor], str, float) -> Dict[str, Tensor]
+    """
+    Statistics of the pixels of a [C, H, W] image under each predicted mask, with
+    the masks in any mask_format of GeneralizedRCNNTransform but "packed". With
+    "roi" or "cropped" masks only the pixels in each mask's box are looked at, so
+    no image-sized masks are made.
+
+    A pixel is under a mask where its probability is above `mask_threshold`.
+    Returns "pixels" (Int64Tensor[N]), the number of pixels under each mask, and
+    the "sum" (float64) and "mean" (nan for an empty mask) of each channel over
+    them, as [N, C]; for a uint8 image, also "histogram", [N, C, 256], the counts
+    of each value in each channel.
+    """
+    masks = prediction["masks"]
+    im_h, im_w = image.shape[-2], image.shape[-1]
+    if mask_format == "roi":
+        masks, mask_boxes = crop_masks_to_boxes(masks, prediction["boxes"], (im_h, im_w))
+        keep_masks = masks > mask_threshold
+    elif mask_format == "cropped":
+        mask_boxes = prediction["mask_boxes"]
+        keep_masks = masks > mask_threshold * 255
+    elif mask_format in ("float", "uint8", "binary"):
+        mask_boxes = torch.tensor([[0, 0, im_w, im_h]], device=masks.device).repeat(masks.shape[0], 1)
+        if mask_format == "float":
+            keep_masks = masks > mask_threshold
+        elif mask_format == "uint8":
+            keep_masks = masks > mask_threshold * 255
+        else:
+            keep_masks = masks
     else:
-        ret = masks.new_empty((0, 1, im_h, im_w))
-    return ret
+        raise ValueError("mask_pixel_stats can't use {} masks".format(mask_format))
+
+    N, C = masks.shape[0], image.shape[0]
+    pixels = torch.zeros((N,), dtype=torch.int64, device=image.device)
+    sums = torch.zeros((N, C), dtype=torch.float64, device=image.device)
+    histogram = image.dtype == torch.uint8
+    histograms = torch.zeros((N, C, 256 if histogram else 0), dtype=torch.int64, device=image.device)
+    channels = torch.arange(C, device=image.device)[:, None] * 256
+    mask_box_list: List[List[int]] = mask_boxes.tolist()
+    for k in range(N):
+        x_0, y_0, x_1, y_1 = mask_box_list[k]
+        keep = keep_masks[k, 0, :y_1 - y_0, :x_1 - x_0]
+        values = image[:, y_0:y_1, x_0:x_1][:, keep]
+        pixels[k] = values.shape[1]
+        sums[k] = values.sum(dim=1, dtype=torch.float64)
+        if histogram:
+            histograms[k] = torch.bincount((values.long() + channels).flatten(), minlength=C * 256).view(C, 256)
+
+    stats = {"pixels": pixels, "sum": sums, "mean": sums / pixels[:, None]}
+    if histogram:
+        stats["histogram"] = histograms
+    return stats
 
 
 class RoIHeads(nn.Module):
@@ -487,6 +675,8 @@ class RoIHeads(nn.Module):
         'box_coder': det_utils.BoxCoder,
         'proposal_matcher': det_utils.Matcher,
         'fg_bg_sampler': det_utils.BalancedPositiveNegativeSampler,
+        'allowed_labels': Optional[List[int]],
+        'detections_per_class': Optional[int],
     }
 
     def __init__(self,
@@ -508,6 +698,9 @@ class RoIHeads(nn.Module):
                  keypoint_roi_pool=None,
                  keypoint_head=None,
                  keypoint_predictor=None,
+                 # Inference filter
+                 allowed_labels=None,
+                 detections_per_class=None,
                  ):
         super(RoIHeads, self).__init__()
 
@@ -533,6 +726,10 @@ class RoIHeads(nn.Module):
         self.score_thresh = score_thresh
         self.nms_thresh = nms_thresh
         self.detections_per_img = detections_per_img
+        # detections are filtered by these, and score_thresh and detections_per_img,
+        # before the mask and keypoint heads run; all can be changed between calls
+        self.allowed_labels = allowed_labels
+        self.detections_per_class = detections_per_class
 
         self.mask_roi_pool = mask_roi_pool
         self.mask_head = mask_head
@@ -542,6 +739,13 @@ class RoIHeads(nn.Module):
         self.keypoint_head = keypoint_head
         self.keypoint_predictor = keypoint_predictor
 
+    def __setstate__(self, state):
+        # heads pickled before these filters were added, e.g. in a whole model
+        # saved with torch.save
+        state.setdefault('allowed_labels', None)
+        state.setdefault('detections_per_class', None)
+        super(RoIHeads, self).__setstate__(state)
+
     def has_mask(self):
         if self.mask_roi_pool is None:
             return False
@@ -703,12 +907,25 @@ class RoIHeads(nn.Module):
             inds = torch.where(scores > self.score_thresh)[0]
             boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
 
+            # remove boxes of labels that aren't wanted
+            allowed_labels = self.allowed_labels
+            if allowed_labels is not None:
+                allowed = torch.tensor(allowed_labels, dtype=labels.dtype, device=device)
+                inds = torch.where((labels[:, None] == allowed[None, :]).any(dim=1))[0]
+                boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
+
             # remove empty boxes
             keep = box_ops.remove_small_boxes(boxes, min_size=1e-2)
             boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
 
             # non-maximum suppression, independently done per class
             keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
+            # keep only the topk scoring predictions of each class (keep is sorted by score)
+            detections_per_class = self.detections_per_class
+            if detections_per_class is not None:
+                one_hot = F.one_hot(labels[keep], num_classes)
+                rank = (one_hot.cumsum(dim=0) * one_hot).sum(dim=1)
+                keep = keep[rank <= detections_per_class]
             # keep only topk scoring predictions
             keep = keep[:self.detections_per_img]
             boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
@@ -6,7 +6,7 @@ from torch import nn, Tensor
 from typing import List, Tuple, Dict, Optional
 
 from .image_list import ImageList
-from .roi_heads import paste_masks_in_image
+from .roi_heads import crop_masks_to_boxes, paste_masks_in_image
 
 
 @torch.jit.unused
@@ -72,9 +72,29 @@ class GeneralizedRCNNTransform(nn.Module):
         - input / target resizing to match min_size / max_size
 
     It returns a ImageList for the inputs, and a List[Dict[Tensor]] for the targets
+
+    In postprocessing, the predicted masks are pasted into the original images in
+    `mask_format` ("float", "uint8", "binary" or "packed"; see paste_masks_in_image),
+    or, not to make image-sized masks at all, are left as the mask head's [N, 1, M, M]
+    probabilities for their boxes ("roi"), or are cropped to their boxes as uint8
+    probabilities times 255 ("cropped"; see crop_masks_to_boxes), with the pixel
+    boxes they cover as "mask_boxes". It can be changed between calls, e.g.
+    model.transform.mask_format = "cropped"; mask_pixel_stats takes masks in any
+    format but "packed".
+
+    In inference, images of the same size, dtype and device are transformed together:
+    each one is resized on its own and copied into its slot of the padded batch (as
+    it is, if it is already the size it would be resized to), and the batch is then
+    normalized in one in-place call. With reuse_batch_buffer, the
+    batch tensor is also kept and reused by the next call with the same batch shape,
+    which is only safe if the model isn't called from more than one thread at once.
     """
+    __annotations__ = {
+        '_batch_buffer': Optional[Tensor],
+    }
 
-    def __init__(self, min_size, max_size, image_mean, image_std, size_divisible=32, fixed_size=None):
+    def __init__(self, min_size, max_size, image_mean, image_std, size_divisible=32, fixed_size=None,
+                 mask_format="float", reuse_batch_buffer=False):
         super(GeneralizedRCNNTransform, self).__init__()
         if not isinstance(min_size, (list, tuple)):
             min_size = (min_size,)
@@ -84,6 +104,17 @@ class GeneralizedRCNNTransform(nn.Module):
         self.image_std = image_std
         self.size_divisible = size_divisible
         self.fixed_size = fixed_size
+        self.mask_format = mask_format
+        self.reuse_batch_buffer = reuse_batch_buffer
+        self._batch_buffer = None
+
+    def __setstate__(self, state):
+        # transforms pickled before these attributes were added, e.g. in a whole
+        # model saved with torch.save
+        state.setdefault('mask_format', 'float')
+        state.setdefault('reuse_batch_buffer', False)
+        state.setdefault('_batch_buffer', None)
+        super(GeneralizedRCNNTransform, self).__setstate__(state)
 
     def forward(self,
                 images,       # type: List[Tensor]
@@ -91,6 +122,8 @@ class GeneralizedRCNNTransform(nn.Module):
                 ):
         # type: (...) -> Tuple[ImageList, Optional[List[Dict[str, Tensor]]]]
         images = [img for img in images]
+        if targets is None and not self.training and not torchvision._is_tracing() and self._same_size(images):
+            return self._transform_same_size(images), targets
         if targets is not None:
             # make a copy of targets to avoid modifying it in-place
             # once torchscript supports dict comprehension
@@ -126,6 +159,67 @@ class GeneralizedRCNNTransform(nn.Module):
         image_list = ImageList(images, image_sizes_list)
         return image_list, targets
 
+    def _same_size(self, images):
+        # type: (List[Tensor]) -> bool
+        if len(images) == 0 or images[0].dim() != 3:
+            return False
+        first = images[0]
+        for image in images[1:]:
+            if image.shape != first.shape or image.dtype != first.dtype or image.device != first.device:
+                return False
+        return True
+
+    def _transform_same_size(self, images):
+        # type: (List[Tensor]) -> ImageList
+        # normalize, resize and batch_images for images of the same size, with
+        # the same results (to rounding, if they are resized) but without the
+        # per-image copies
+        first = images[0]
+        if not first.is_floating_point():
+            raise TypeError(
+                f"Expected input images to be of floating type (in range [0, 1]), "
+                f"but found type {first.dtype} instead"
+            )
+        h, w = first.shape[-2], first.shape[-1]
+        if self.fixed_size is not None:
+            fixed_size = self.fixed_size
+            out_h, out_w = fixed_size[1], fixed_size[0]
+        else:
+            im_shape = torch.tensor([h, w])
+            min_size = torch.min(im_shape).to(dtype=torch.float32)
+            max_size = torch.max(im_shape).to(dtype=torch.float32)
+            scale = torch.min(float(self.min_size[-1]) / min_size, float(self.max_size) / max_size).item()
+            out_h, out_w = int(math.floor(h * scale)), int(math.floor(w * scale))
+
+        stride = float(self.size_divisible)
+        batch_shape = [len(images), first.shape[0],
+                       int(math.ceil(float(out_h) / stride) * stride), int(math.ceil(float(out_w) / stride) * stride)]
+        buffer = self._batch_buffer
+        if buffer is not None and list(buffer.shape) == batch_shape and buffer.dtype == first.dtype \
+                and buffer.device == first.device:
+            batched_imgs = buffer
+            # the last call may have had another size inside the same padding
+            batched_imgs[:, :, out_h:].zero_()
+            batched_imgs[:, :, :, out_w:].zero_()
+        else:
+            batched_imgs = first.new_zeros(batch_shape)
+        self._batch_buffer = batched_imgs if self.reuse_batch_buffer else None
+
+        # the images are resized before they are normalized, so only the pixels
+        # kept are normalized, all in one go
+        unpadded_imgs = batched_imgs[:, :, :out_h, :out_w]
+        for img, pad_img in zip(images, unpadded_imgs):
+            if (out_h, out_w) != (h, w):
+                img = torch.nn.functional.interpolate(img[None], size=[out_h, out_w], mode='bilinear',
+                                                      align_corners=False)[0]
+            pad_img.copy_(img)
+        mean = torch.as_tensor(self.image_mean, dtype=first.dtype, device=first.device)
+        std = torch.as_tensor(self.image_std, dtype=first.dtype, device=first.device)
+        unpadded_imgs.sub_(mean[:, None, None]).div_(std[:, None, None])
+
+        image_sizes_list: List[Tuple[int, int]] = [(out_h, out_w)] * len(images)
+        return ImageList(batched_imgs, image_sizes_list)
+
     def normalize(self, image):
         if not image.is_floating_point():
             raise TypeError(
@@ -235,11 +329,16 @@ class GeneralizedRCNNTransform(nn.Module):
             return result
         for i, (pred, im_s, o_im_s) in enumerate(zip(result, image_shapes, original_image_sizes)):
             boxes = pred["boxes"]
-            boxes = resize_boxes(boxes, im_s, o_im_s)
-            result[i]["boxes"] = boxes
-            if "masks" in pred:
+            if im_s != o_im_s:
+                boxes = resize_boxes(boxes, im_s, o_im_s)
+                result[i]["boxes"] = boxes
+            if "masks" in pred and self.mask_format == "cropped":
+                masks, mask_boxes = crop_masks_to_boxes(pred["masks"], boxes, o_im_s)
+                result[i]["masks"] = masks.mul_(255).round_().to(torch.uint8)
+                result[i]["mask_boxes"] = mask_boxes
+            elif "masks" in pred and self.mask_format != "roi":
                 masks = pred["masks"]
-                masks = paste_masks_in_image(masks, boxes, o_im_s)
+                masks = paste_masks_in_image(masks, boxes, o_im_s, mask_format=self.mask_format)
                 result[i]["masks"] = masks
             if "keypoints" in pred:
                 keypoints = pred["keypoints"]
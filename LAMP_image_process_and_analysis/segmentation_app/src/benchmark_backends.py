@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Compares the inference backends of the segmentation app on the CPU.
+
+Runs every image, one at a time, through each backend at each thread count.
+For each combination it prints the per-image latency (p50 and p95), the
+throughput and speedup over the eager PyTorch model at the same thread count,
+and how far its union masks, quadrant green scores and threshold_test calls
+are from the eager model's. Give it held-out images, in pairs (0 min. and 61
+min. of each assay), for the calls to be compared:
+
+    python benchmark_backends.py path/to/cropped --backends onnxruntime int8 bf16 --threads 1 2 4 8
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from torchvision.io import ImageReadMode, read_image
+from torchvision.transforms.functional import convert_image_dtype
+
+from model_to_green_value import backends, device, get_outputs, green_quadrants, load_backend, threshold_test
+
+
+# Union mask and quadrant green scores of each image, and the seconds each image
+# took (forward pass and parsing).
+def run_backend(model, images, threshold, repeats=1):
+    masks, scores, seconds = list(), list(), list()
+    get_outputs(images[0][1][None], model, threshold)
+    for repeat in range(repeats):
+        for image_int, image in images:
+            start = time.perf_counter()
+            mask, boxes, labels = get_outputs(image[None], model, threshold)[0]
+            seconds.append(time.perf_counter() - start)
+            if repeat == 0:
+                masks.append(mask)
+                scores.append(green_quadrants(image_int[None], mask[None])[0])
+    return masks, scores, seconds
+
+
+# The positive/negative calls threshold_test makes for each pair of images (0
+# min. and 61 min. in turn) from their quadrant green scores.
+def pair_calls(scores):
+    scores = [score.cpu().numpy() for score in scores]
+    return [status for z, s in zip(scores[0::2], scores[1::2])
+            for item in threshold_test(z, s)[1:] for status, score in item.values()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the latency, throughput and results of the model backends.")
+    parser.add_argument("images", nargs="+", help="a directory of .png chip images, or the images")
+    parser.add_argument("--backends", nargs="+", default=["onnxruntime"], choices=backends,
+                        help="backends to compare with eager, which is always run")
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 2, 4], help="CPU thread counts to try")
+    parser.add_argument("--threshold", type=float, default=0.9, help="lowest score of a detection that is kept")
+    parser.add_argument("--repeats", type=int, default=1, help="times to run each image")
+    parser.add_argument("--params", default="MaskModelParams.pth", help="model parameters file (eager only)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    paths = args.images
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        paths = sorted(os.path.join(paths[0], file) for file in os.listdir(paths[0]) if file.endswith(".png"))
+    images = list()
+    for path in paths:
+        image_int = read_image(path, ImageReadMode.RGB).to(device)
+        images.append((image_int, convert_image_dtype(image_int, dtype=torch.float)))
+
+    # eager is always run first at each thread count, for the speedups; its
+    # results at the first thread count are the reference for the others
+    reference_masks = reference_scores = reference_calls = None
+    default_threads = torch.get_num_threads()
+
+    print("{:<12} {:>7} {:>10} {:>10} {:>9} {:>8} {:>12} {:>11} {:>12}".format(
+        "backend", "threads", "p50 ms", "p95 ms", "images/s", "speedup", "mask diff %", "score diff", "calls agree"))
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for backend in ['eager'] + [backend for backend in args.backends if backend != 'eager']:
+            model = load_backend(backend, params_path=args.params, threads=threads)
+            masks, scores, seconds = run_backend(model, images, args.threshold, args.repeats)
+            rate = len(seconds) / sum(seconds)
+            if backend == 'eager':
+                eager_rate = rate
+            if reference_masks is None:
+                reference_masks, reference_scores, reference_calls = masks, scores, pair_calls(scores)
+            mask_diff = np.mean([(mask != reference).float().mean().item()
+                                 for mask, reference in zip(masks, reference_masks)]) * 100
+            score_diff = max(np.nanmax(np.abs((score - reference).cpu().numpy()), initial=0)
+                             for score, reference in zip(scores, reference_scores))
+            calls = pair_calls(scores)
+            agree = sum(call == reference for call, reference in zip(calls, reference_calls))
+            print("{:<12} {:>7} {:>10.1f} {:>10.1f} {:>9.2f} {:>8.2f} {:>12.4f} {:>11.4f} {:>12}".format(
+                backend, threads, np.percentile(seconds, 50) * 1000, np.percentile(seconds, 95) * 1000,
+                rate, rate / eager_rate, mask_diff, score_diff, "{}/{}".format(agree, len(calls))))
+    torch.set_num_threads(default_threads)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Calibrates and saves an int8 version of the segmentation model for the CPU.
+
+The model is run in float over cropped chip images while the ranges of the
+activations in its ResNet body are recorded, then that body is converted to
+int8, as is the box head (see quantize_model in model_to_green_value.py). Use
+chip images like the ones the model will see, but not the ones it will be
+checked on:
+
+    python calibrate_int8.py path/to/calibration/cropped     # MaskModelParams_int8.pth
+    python benchmark_backends.py path/to/held_out/cropped --backends int8 bf16
+    python model_to_green_value.py cropped --backend int8
+"""
+
+import argparse
+import os
+import time
+
+import torch
+from torchvision.io import ImageReadMode, read_image
+from torchvision.transforms.functional import convert_image_dtype
+
+from model_to_green_value import load_model, quantize_model
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrate and save an int8 version of the segmentation model.")
+    parser.add_argument("images", nargs="+", help="a directory of .png chip images, or the images")
+    parser.add_argument("--limit", type=int, default=32, help="most images to calibrate with")
+    parser.add_argument("--model", default="MaskInstanceModel.pth", help="pickled model file")
+    parser.add_argument("--params", default="MaskModelParams.pth", help="model parameters file")
+    parser.add_argument("--output", default="MaskModelParams_int8.pth", help="int8 parameters file to write")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    paths = args.images
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        paths = sorted(os.path.join(paths[0], file) for file in os.listdir(paths[0]) if file.endswith(".png"))
+    paths = paths[:args.limit]
+    if not paths:
+        raise FileNotFoundError("No calibration images found in {}.".format(args.images))
+    images = (convert_image_dtype(read_image(path, ImageReadMode.RGB), dtype=torch.float) for path in paths)
+
+    start = time.perf_counter()
+    model = quantize_model(load_model(args.model, args.params), images)
+    torch.save(model.state_dict(), args.output)
+    print("Calibrated on {} images in {:.1f} s; saved {}.".format(len(paths), time.perf_counter() - start, args.output))
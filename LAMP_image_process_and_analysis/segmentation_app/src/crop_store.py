@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Crop store. A directory of shards, each one .npy file holding the crops of one
+# ingest run as a single contiguous uint8 array of shape [N, 3, size, size]
+# (channels first, like torchvision's read_image), and an index.jsonl with one
+# line per stored crop: source image, crop file, shard and row. Downstream code
+# can np.load the shards with mmap_mode and hand rows to torch.from_numpy
+# without decoding or copying anything.
+# This module is the only code that knows the layout, and it needs only numpy
+# and torch. The image prep app writes stores with it (ingest --store); the
+# segmentation app and the training script read them with it. Each app is built
+# from its own directory, so each has a copy of this file:
+# image_prep_app/src/crop_store.py is the original, and the copies in
+# segmentation_app/src and instance_seg_training must be kept identical to it.
+
+import json
+import os
+
+import numpy as np
+import torch
+import torch.utils.data
+
+INDEX_NAME = "index.jsonl"
+SHARD_PREFIX = "crops-"
+
+
+# A new, empty shard for count crops of size x size in store_dir (created if
+# needed), named after the shards already there. Returns its path.
+def new_store_shard(store_dir, count, size):
+    os.makedirs(store_dir, exist_ok=True)
+    n_shards = len([f for f in os.listdir(store_dir) if f.startswith(SHARD_PREFIX)])
+    shard_path = os.path.join(store_dir, "{}{:05d}.npy".format(SHARD_PREFIX, n_shards))
+    np.lib.format.open_memmap(shard_path, mode="w+", dtype=np.uint8,
+                              shape=(count, 3, size, size)).flush()
+    return shard_path
+
+# Copy an RGB crop (uint8 [size, size, 3]) into a row of a shard.
+def write_store_row(shard_path, row, crop):
+    shard = np.load(shard_path, mmap_mode="r+")
+    shard[row] = np.asarray(crop).transpose(2, 0, 1)
+    shard.flush()
+    del shard
+
+# Add a crop written with write_store_row to the index. res holds the source
+# "image", the "crop" file, and the "shard" (file name) and "row" it is in.
+def record_stored(store_dir, res):
+    with open(os.path.join(store_dir, INDEX_NAME), "a") as f:
+        f.write(json.dumps(dict(image=res["image"], crop=res["crop"],
+                                shard=res["shard"], row=res["row"])) + "\n")
+
+# The index entries of a store, in the order they were written.
+def read_entries(store_dir):
+    with open(os.path.join(store_dir, INDEX_NAME)) as f:
+        return [json.loads(line) for line in f]
+
+# The index of a crop store as a dict from crop file name (without its directory)
+# to (shard, row). A crop that was stored more than once maps to its newest row.
+def read_index(store_dir):
+    return {os.path.basename(entry["crop"]): (entry["shard"], entry["row"])
+            for entry in read_entries(store_dir)}
+
+# Read the index of a crop store and memory-map its shards. Returns the index
+# entries in the order they were written, each with an "array" entry that is a
+# [3, size, size] view into its shard. The default copy-on-write mode gives
+# writable arrays (so torch.from_numpy doesn't warn) that never touch the files.
+def open_store(store_dir, mmap_mode="c"):
+    shards = dict()
+    index = read_entries(store_dir)
+    for entry in index:
+        if entry["shard"] not in shards:
+            shards[entry["shard"]] = np.load(os.path.join(store_dir, entry["shard"]),
+                                             mmap_mode=mmap_mode)
+        entry["array"] = shards[entry["shard"]][entry["row"]]
+    return index
+
+# Crops out of a crop store, looked up by the names of their crop files (paths
+# are fine, only the base name is used), one uint8 [3, size, size] tensor per
+# item: the same as read_image of the PNG, without decoding it.
+# Shards are memory-mapped the first time a process reads from them, so each
+# DataLoader worker maps the files itself instead of being sent a copy of them.
+class stored_crops(torch.utils.data.Dataset):
+    def __init__(self, store_dir, names, mmap_mode="c"):
+        index = read_index(store_dir)
+        missing = [name for name in names if os.path.basename(name) not in index]
+        if missing:
+            raise KeyError("{} of the crops are not in the crop store {}, e.g. {}.".format(
+                len(missing), store_dir, missing[0]))
+        self.store_dir = store_dir
+        self.rows = [index[os.path.basename(name)] for name in names]
+        self.mmap_mode = mmap_mode
+        self.shards = dict()
+
+    def crop(self, idx):
+        shard, row = self.rows[idx]
+        if shard not in self.shards:
+            self.shards[shard] = np.load(os.path.join(self.store_dir, shard), mmap_mode=self.mmap_mode)
+        return torch.from_numpy(self.shards[shard][row])
+
+    def __getitem__(self, idx):
+        return self.crop(idx)
+
+    def __len__(self):
+        return len(self.rows)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Exports the fine-tuned Mask R-CNN for the segmentation app.
+
+The app loads the model by unpickling the whole module, which needs the same
+torchvision classes it was saved with, and then loads the parameters over it.
+This writes a TorchScript file with the parameters in it instead, using the
+scripting support in torchvision's detection models, or an ONNX file for ONNX
+Runtime, using its ONNX export:
+
+    python export_model.py                      # MaskInstanceModel.pt
+    python model_to_green_value.py cropped --backend torchscript
+
+    python export_model.py --format onnx --sample cropped/assay_00.png
+    python model_to_green_value.py cropped --backend onnxruntime
+"""
+
+import argparse
+import time
+
+import torch
+from torchvision.io import ImageReadMode, read_image
+from torchvision.transforms.functional import convert_image_dtype
+
+from model_to_green_value import (add_model_args, apply_profile, device, load_model, load_onnx_model,
+                                  load_scripted_model, model_profiles)
+
+
+def export_torchscript(model, output, freeze=False):
+    scripted = torch.jit.script(model)
+    if freeze:
+        scripted = torch.jit.freeze(scripted)
+    torch.jit.save(scripted, output)
+    return scripted
+
+
+# The ONNX graph is traced from one run of the model on `sample`, a float
+# [3, H, W] image. It should be a real chip image with wells in it, so every
+# branch the model takes for our images is traced; height and width are left
+# free, so other sizes work too. One image goes through the graph per run.
+def export_onnx(model, output, sample, opset_version=11):
+    torch.onnx.export(model, ([sample],), output, opset_version=opset_version, do_constant_folding=True,
+                      input_names=["images_tensors"], output_names=["boxes", "labels", "scores", "masks"],
+                      dynamic_axes={"images_tensors": [1, 2], "boxes": [0], "labels": [0],
+                                    "scores": [0], "masks": [0, 2, 3]})
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export the segmentation model to TorchScript or ONNX.")
+    parser.add_argument("--model", default="MaskInstanceModel.pth", help="pickled model file")
+    parser.add_argument("--params", default="MaskModelParams.pth", help="model parameters file")
+    parser.add_argument("--format", default="torchscript", choices=("torchscript", "onnx"),
+                        help="kind of file to write")
+    parser.add_argument("--output", default=None,
+                        help="file to write (default MaskInstanceModel.pt, or MaskInstanceModel.onnx for onnx)")
+    parser.add_argument("--freeze", action="store_true",
+                        help="torchscript: freeze the parameters into the graph before saving; the loader "
+                             "does this anyway, but a frozen file can't be fine-tuned further")
+    parser.add_argument("--sample", default=None,
+                        help="onnx: a cropped chip image to trace the model with (required)")
+    parser.add_argument("--opset", type=int, default=11, help="onnx: opset version")
+    add_model_args(parser, profile_only=True)
+    args = parser.parse_args(argv)
+    if args.format == "onnx" and args.sample is None:
+        parser.error("--format onnx needs --sample, a cropped chip image to trace the model with")
+    if args.output is None:
+        args.output = "MaskInstanceModel.onnx" if args.format == "onnx" else "MaskInstanceModel.pt"
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start = time.perf_counter()
+    model = load_model(args.model, args.params)
+    eager_seconds = time.perf_counter() - start
+    # The box head drops detections at or below --threshold, see load_from_args.
+    settings = dict(model_profiles[args.profile]) if args.profile else dict()
+    settings['box_score_thresh'] = args.threshold
+    apply_profile(model, settings)
+    if args.format == "onnx":
+        sample = convert_image_dtype(read_image(args.sample, ImageReadMode.RGB), dtype=torch.float).to(device)
+        export_onnx(model, args.output, sample, args.opset)
+        print("Saved {}.".format(args.output))
+        start = time.perf_counter()
+        load_onnx_model(args.output)
+    else:
+        export_torchscript(model, args.output, args.freeze)
+        print("Saved {}.".format(args.output))
+        start = time.perf_counter()
+        load_scripted_model(args.output)
+    print("Loading on {}: {:.2f} s for the pickled model, {:.2f} s for {}.".format(
+        device, eager_seconds, time.perf_counter() - start, args.output))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Sends assay image pairs to green_value_server.py and prints the results.
+
+Takes the same directory of images model_to_green_value.py does (the 0 min. and
+61 min. image of each assay, in sorted order), or the images themselves, and
+prints one "Result for ..." line per pair, in the script's format.
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+# http.client connection over a Unix socket.
+class unix_connection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connection(url, socket_path, timeout):
+    if socket_path:
+        return unix_connection(socket_path, timeout)
+    host = url.split('://', 1)[-1].rstrip('/')
+    return http.client.HTTPConnection(host, timeout=timeout)
+
+
+# IMAGE for a request: the path (made absolute, since the server has its own
+# working directory) or, with send_bytes, the file contents.
+def image_item(path, send_bytes):
+    if send_bytes:
+        with open(path, 'rb') as f:
+            return {'data': base64.b64encode(f.read()).decode()}
+    return {'path': os.path.abspath(path)}
+
+
+def server_stats(url="http://127.0.0.1:8765", socket_path=None, timeout=60):
+    conn = connection(url, socket_path, timeout)
+    try:
+        conn.request('GET', '/stats')
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def analyze(zero, end, url="http://127.0.0.1:8765", socket_path=None, send_bytes=False, timeout=600):
+    body = json.dumps({'zero': image_item(zero, send_bytes), 'end': image_item(end, send_bytes)})
+    conn = connection(url, socket_path, timeout)
+    try:
+        conn.request('POST', '/analyze', body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        content = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError("Server error for {}: {}".format(os.path.basename(zero), content.get('error')))
+    return content['result']
+
+
+# The images waiting for analysis, as the script lists them: the .png files of a
+# directory, sorted, or the files given.
+def waiting_images(paths):
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        paths = sorted(os.path.join(paths[0], file) for file in os.listdir(paths[0]) if file.endswith(".png"))
+    if len(paths) % 2 == 1:
+        raise IndexError("Error: odd number of images. Is there a 0 min. image and a 61 min. image for each assay?")
+    return paths
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score assay image pairs with a running green_value_server.py.")
+    parser.add_argument("images", nargs="+",
+                        help="a directory of .png images, or the images, 0 min. and 61 min. of each assay in turn")
+    parser.add_argument("--url", default="http://127.0.0.1:8765", help="address of the server")
+    parser.add_argument("--socket", default=None, help="Unix socket of the server, instead of --url")
+    parser.add_argument("--send-bytes", action="store_true",
+                        help="send the image files instead of their paths, for a server on another machine")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the server's batching and latency counters after the results")
+    parser.add_argument("--parallel", type=int, default=4,
+                        help="pairs in flight at once, so the server can batch them")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        paths = waiting_images(args.images)
+    except IndexError as error:
+        sys.exit(str(error))
+    pairs = list(zip(paths[0::2], paths[1::2]))
+    with ThreadPoolExecutor(max(1, args.parallel)) as pool:
+        results = list(pool.map(lambda pair: analyze(pair[0], pair[1], args.url, args.socket, args.send_bytes), pairs))
+    if args.json:
+        print(json.dumps([{'zero': zero, 'end': end, 'result': result}
+                          for (zero, end), result in zip(pairs, results)], indent=2))
+    else:
+        for (zero, end), result in zip(pairs, results):
+            print("Result for {} is {}.\n".format(os.path.basename(zero), result))
+    if args.stats:
+        print(json.dumps(server_stats(args.url, args.socket), indent=2))
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Keeps the segmentation model loaded and answers assay requests.
+
+model_to_green_value.py loads torch, the pickled model and its parameters on
+every run, which takes longer than the analysis of a few images. This server
+does that once and then scores image pairs sent to it over HTTP, on a TCP port
+or a Unix socket:
+
+    POST /analyze  {"zero": IMAGE, "end": IMAGE}
+    GET  /health
+    GET  /stats    request counts, throughput and p50/p95 latencies
+
+where each IMAGE is {"path": "..."} for a file the server can read, or
+{"data": "<base64 PNG/JPEG bytes>"}. The reply is the same list of dictionaries
+the script prints, as JSON. Requests are batched by image size, for up to
+--max-delay seconds or --max-pairs pairs, so pairs sent at around the same time
+share a forward pass. green_value_client.py is the matching client.
+"""
+
+import argparse
+import base64
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from torchvision.io import decode_image, read_image
+
+from model_to_green_value import add_model_args, analyze_pairs, device, load_from_args, load_layout, result_to_json
+
+
+# Reads one IMAGE of a request into a uint8 [C, H, W] tensor.
+def request_image(item):
+    if 'path' in item:
+        return read_image(item['path'])
+    if 'data' in item:
+        data = bytearray(base64.b64decode(item['data']))
+        return decode_image(torch.frombuffer(data, dtype=torch.uint8))
+    raise ValueError("An image needs a 'path' or 'data'.")
+
+
+# Micro-batching in front of the model. Pairs are kept in one bucket per image
+# size. A bucket goes through the model in one forward pass as soon as it holds
+# max_pairs pairs, or when its oldest pair has waited max_delay seconds, so a
+# lone request is held back at most max_delay while pairs from several benches
+# arriving together share a pass. Latencies and counts are kept for stats().
+class pair_batcher:
+    def __init__(self, model, threshold=0.9, layout=None, colour=(), well_stats=False, max_pairs=8, max_delay=0.02,
+                 window=1000):
+        self.model = model
+        self.threshold = threshold
+        self.layout = layout
+        self.colour = colour
+        self.well_stats = well_stats
+        self.max_pairs = max_pairs
+        self.max_delay = max_delay
+        self.waiting = queue.Queue()
+        # the last `window` request latencies and forward pass times, in seconds
+        self.latencies = deque(maxlen=window)
+        self.forward_times = deque(maxlen=window)
+        self.counts = {'pairs': 0, 'failed': 0, 'batches': 0}
+        self.busy = 0.0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queue a pair (uint8 [2, C, H, W]); the Future gets its result.
+    def submit(self, pair):
+        future = Future()
+        self.waiting.put((pair, future, time.perf_counter()))
+        return future
+
+    def run(self):
+        buckets = dict()
+        while True:
+            timeout = None
+            if buckets:
+                oldest = min(bucket[0][2] for bucket in buckets.values())
+                timeout = max(0, oldest + self.max_delay - time.perf_counter())
+            try:
+                item = self.waiting.get(timeout=timeout)
+                while True:
+                    buckets.setdefault(tuple(item[0].shape), list()).append(item)
+                    item = self.waiting.get_nowait()
+            except queue.Empty:
+                pass
+            now = time.perf_counter()
+            for size in list(buckets):
+                bucket = buckets[size]
+                while len(bucket) >= self.max_pairs:
+                    self.run_group(bucket[:self.max_pairs])
+                    del bucket[:self.max_pairs]
+                if bucket and now - bucket[0][2] >= self.max_delay:
+                    self.run_group(bucket)
+                    bucket = []
+                if bucket:
+                    buckets[size] = bucket
+                else:
+                    del buckets[size]
+
+    def run_group(self, group):
+        start = time.perf_counter()
+        failure = None
+        try:
+            batch_int = torch.cat([pair for pair, future, arrived in group]).to(device)
+            results = [result_to_json(result) for result in
+                       analyze_pairs(batch_int, self.model, self.threshold, self.layout, self.colour,
+                                     self.well_stats)]
+        except Exception as error:
+            failure = error
+        done = time.perf_counter()
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['pairs' if failure is None else 'failed'] += len(group)
+            self.busy += done - start
+            self.forward_times.append(done - start)
+            self.latencies.extend(done - arrived for pair, future, arrived in group)
+        for i, (pair, future, arrived) in enumerate(group):
+            if failure is not None:
+                future.set_exception(failure)
+            else:
+                future.set_result(results[i])
+
+    # Counters since the server started, and p50/p95 of the recent request
+    # latencies (arrival to result, queueing included) and forward passes, in ms.
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            forward_times = np.array(self.forward_times) * 1000
+            stats = dict(self.counts, busy_seconds=self.busy,
+                         uptime_seconds=time.perf_counter() - self.started,
+                         max_pairs=self.max_pairs, max_delay_ms=self.max_delay * 1000)
+        stats['pairs_per_batch'] = stats['pairs'] / stats['batches'] if stats['batches'] else None
+        stats['pairs_per_second'] = stats['pairs'] / stats['uptime_seconds']
+        stats['pairs_per_busy_second'] = stats['pairs'] / stats['busy_seconds'] if stats['busy_seconds'] else None
+        for name, values in (('latency', latencies), ('forward', forward_times)):
+            for q in (50, 95):
+                stats['{}_p{}_ms'.format(name, q)] = float(np.percentile(values, q)) if len(values) else None
+        return stats
+
+
+class request_handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, {'status': 'ok', 'device': str(device)})
+        elif self.path == '/stats':
+            self.reply(200, self.server.batcher.stats())
+        else:
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/analyze':
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            zero, end = request_image(body['zero']), request_image(body['end'])
+            if zero.shape != end.shape:
+                raise ValueError("The 0 min. and 61 min. images are different sizes: {} and {}.".format(
+                    tuple(zero.shape), tuple(end.shape)))
+        except (KeyError, ValueError, OSError, RuntimeError) as error:
+            self.reply(400, {'error': str(error)})
+            return
+        try:
+            result = self.server.batcher.submit(torch.stack([zero, end])).result()
+        except Exception as error:
+            self.reply(500, {'error': str(error)})
+            return
+        self.reply(200, {'result': result})
+
+    def reply(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Unix socket clients have no address.
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'local'
+
+
+class unix_http_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Keep the segmentation model loaded and score assay image pairs sent over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port to listen on")
+    parser.add_argument("--socket", default=None,
+                        help="listen on this Unix socket path instead of a TCP port")
+    add_model_args(parser)
+    parser.add_argument("--layout", default=None,
+                        help="chamber layout file; without one the images are split into quadrants")
+    parser.add_argument("--well-stats", action="store_true",
+                        help="add the statistics of every well and chamber to the results (with --layout)")
+    parser.add_argument("--colour", nargs="*", default=(), choices=("hsv", "lab"),
+                        help="colour spaces to add per-well means in to the well statistics (with --layout; "
+                             "implies --well-stats)")
+    parser.add_argument("--max-pairs", type=int, default=8,
+                        help="most pairs that go through the model in one forward pass")
+    parser.add_argument("--max-delay", type=float, default=0.02,
+                        help="longest a pair waits, in seconds, for others of its size to share a forward pass")
+    args = parser.parse_args(argv)
+    args.well_stats = args.well_stats or bool(args.colour)
+    if args.well_stats and not args.layout:
+        parser.error("--well-stats and --colour need --layout")
+    return args
+
+
+def serve(args):
+    model = load_from_args(args)
+    layout = load_layout(args.layout) if args.layout else None
+    # One pass on a blank image so the first request doesn't pay for the
+    # allocator and kernel set up.
+    analyze_pairs(torch.zeros(2, 3, 64, 64, dtype=torch.uint8, device=device), model, args.threshold, layout,
+                  args.colour, args.well_stats)
+    if args.socket:
+        server = unix_http_server(args.socket, request_handler)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), request_handler)
+        where = "http://{}:{}".format(args.host, args.port)
+    server.batcher = pair_batcher(model, args.threshold, layout, tuple(args.colour), args.well_stats,
+                                  args.max_pairs, args.max_delay)
+    print("Model loaded on {}; listening on {}".format(device, where), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    serve(parse_args())
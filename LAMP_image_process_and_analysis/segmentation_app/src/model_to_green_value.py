@@ -8,6 +8,8 @@ Original file is located at
 """
 
 # Base libraries
+import argparse
+import copy
 import os
 import numpy as np
 from PIL import Image
@@ -19,6 +21,7 @@ import warnings
 import sys
 import pandas as pd
 import re
+import json
 #from git import Repo
 #from pathlib import Path
 
@@ -26,12 +29,17 @@ import re
 import torch
 import torch.utils.data
 import torchvision
+from torch import nn
+from torch.ao.quantization import get_default_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
 from torchvision.io import read_image
 from torchvision.transforms.functional import convert_image_dtype
 import torchvision.transforms.functional as F
 
+from crop_store import read_index, stored_crops
+
 ### Next 15 lines don't seem necessary for model.eval()
 ### They will probably be necessary for model.train()
 # Check if directory for additional Torch libraries exists
@@ -91,12 +99,201 @@ device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cp
 warnings.filterwarnings("ignore")#, message="UserWarning: Named tensors and all their associated")
 
 # Load the model from the saved file:
-model = torch.load('MaskInstanceModel.pth', map_location=device)
-model.load_state_dict(torch.load('MaskModelParams.pth', map_location=device))
-#model.to(device)
-
-#The output from this can be cleared from the screen. Don't know how to do that.
-model.eval()
+def load_model(model_path='MaskInstanceModel.pth', params_path='MaskModelParams.pth'):
+    model = torch.load(model_path, map_location=device)
+    model.load_state_dict(torch.load(params_path, map_location=device))
+    #model.to(device)
+
+    #The output from this can be cleared from the screen. Don't know how to do that.
+    model.eval()
+    return model
+
+# Load a TorchScript export of the model (see export_model.py). This needs no
+# Python classes for the model and skips the second load of the parameters.
+# With optimize, torch.jit.optimize_for_inference freezes the weights into the
+# graph and folds batch norms and the like for inference. Returns a
+# scripted_detector, so it is called the same way as the eager model.
+def load_scripted_model(model_path='MaskInstanceModel.pt', optimize=True):
+    model = torch.jit.load(model_path, map_location=device)
+    model.eval()
+    if optimize:
+        model = torch.jit.optimize_for_inference(model)
+    return scripted_detector(model)
+
+# A scripted Mask R-CNN takes a list of images and returns (losses, detections).
+# This takes a batch tensor, or a list, and returns the detections, as the eager
+# model does.
+class scripted_detector:
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, images):
+        losses, detections = self.module(list(images))
+        return detections
+
+    def eval(self):
+        return self
+
+# Load an ONNX export of the model (export_model.py --format onnx) into an
+# ONNX Runtime session on the CPU, with `threads` threads for each operator
+# (ONNX Runtime's default, one per core, if None). Returns an onnx_detector, so
+# it is called the same way as the eager model.
+def load_onnx_model(model_path='MaskInstanceModel.onnx', threads=None):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("The onnxruntime backend needs ONNX Runtime: pip install onnxruntime")
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+    return onnx_detector(session)
+
+# The exported graph takes one float [C, H, W] image and returns its boxes,
+# labels, scores and masks. This runs it for each image of a batch and returns
+# the detections as tensors on the device, as the eager model does.
+class onnx_detector:
+    output_names = ('boxes', 'labels', 'scores', 'masks')
+
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def __call__(self, images):
+        detections = list()
+        for image in images:
+            outputs = self.session.run(None, {self.input_name: image.cpu().numpy()})
+            detections.append({name: torch.from_numpy(output).to(device)
+                               for name, output in zip(self.output_names, outputs)})
+        return detections
+
+    def eval(self):
+        return self
+
+# Folds the batch norms of the ResNet body of the backbone into the convolution
+# before each of them, and replaces them with nn.Identity. The model computes
+# the same thing (the norms are fixed at inference), but each conv can then be
+# quantized on its own.
+def fold_batch_norms(body):
+    def fold(conv, bn):
+        scale = bn.weight * (bn.running_var + bn.eps).rsqrt()
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.bias)
+        conv.weight = nn.Parameter(conv.weight * scale.reshape(-1, 1, 1, 1))
+        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+    with torch.no_grad():
+        fold(body.conv1, body.bn1)
+        body.bn1 = nn.Identity()
+        for layer in (body.layer1, body.layer2, body.layer3, body.layer4):
+            for block in layer:
+                for i in (1, 2, 3):
+                    fold(getattr(block, 'conv{}'.format(i)), getattr(block, 'bn{}'.format(i)))
+                    setattr(block, 'bn{}'.format(i), nn.Identity())
+                if block.downsample is not None:
+                    fold(block.downsample[0], block.downsample[1])
+                    block.downsample[1] = nn.Identity()
+
+# An int8 copy of a model for the CPU. The ResNet body of the backbone is
+# statically quantized (FX graph mode, fbgemm): activation ranges are observed
+# while the model runs over calibration_images (float [C, H, W] chip images),
+# then it is converted. The Linear layers of the box head are quantized
+# dynamically. The FPN, RPN and mask head stay in float. With no calibration
+# images this only builds the structure, to load a saved state_dict into.
+def quantize_model(model, calibration_images=()):
+    model = copy.deepcopy(model).cpu().eval()
+    fold_batch_norms(model.backbone.body)
+    model.backbone.body = prepare_fx(model.backbone.body, {"": get_default_qconfig("fbgemm")},
+                                     (torch.zeros(1, 3, 64, 64),))
+    with torch.no_grad():
+        for image in calibration_images:
+            model([image])
+    model.backbone.body = convert_fx(model.backbone.body)
+    model.roi_heads.box_head = quantize_dynamic(model.roi_heads.box_head, {nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+# Load the int8 model saved by calibrate_int8.py. A quantized graph can't be
+# unpickled like the float model, so the float model is loaded, its int8
+# structure is rebuilt and the saved int8 state_dict is loaded into it.
+def load_quantized_model(quant_path='MaskModelParams_int8.pth', model_path='MaskInstanceModel.pth',
+                         params_path='MaskModelParams.pth'):
+    if device.type != 'cpu':
+        raise ValueError("The int8 model only runs on the CPU.")
+    model = quantize_model(load_model(model_path, params_path))
+    model.load_state_dict(torch.load(quant_path, map_location=device))
+    return model
+
+# Runs a model under bfloat16 autocast, for CPUs with bf16 support (AVX512-BF16
+# or AMX), and returns its detections in float32 again.
+class autocast_detector:
+    def __init__(self, model, dtype=torch.bfloat16):
+        self.model = model
+        self.dtype = dtype
+
+    def __call__(self, images):
+        with torch.autocast(device.type, dtype=self.dtype):
+            detections = self.model(images)
+        return [{name: value.float() if value.is_floating_point() else value for name, value in output.items()}
+                for output in detections]
+
+    def eval(self):
+        return self
+
+# Inference settings for the model, in the same terms as the keyword arguments
+# of torchvision's detection model builders (see the low resolution mobile
+# config of fasterrcnn_mobilenet_v3_large_320_fpn). 'coco' is what the model is
+# built with; 'lamp_chip' is for our crops, which hold a handful of large wells
+# at a known scale, so a smaller input, fewer proposals and fewer detections
+# are enough. sweep_profiles.py measures the speed and masks of other settings.
+model_profiles = {
+    'coco': dict(min_size=800, max_size=1333, rpn_pre_nms_top_n_test=1000,
+                 rpn_post_nms_top_n_test=1000, box_detections_per_img=100),
+    'lamp_chip': dict(min_size=640, max_size=640, rpn_pre_nms_top_n_test=150,
+                      rpn_post_nms_top_n_test=150, box_detections_per_img=32),
+}
+
+# Changes the inference settings of a loaded model in place, from a name in
+# model_profiles or a dict of the same keys (box_score_thresh can be set too).
+# Only models that run in Python can be changed (eager, int8, bf16); to use a
+# profile with torchscript or onnxruntime, export the model with it.
+def apply_profile(model, profile):
+    settings = model_profiles[profile] if isinstance(profile, str) else profile
+    model = getattr(model, 'model', model)
+    if not hasattr(model, 'transform'):
+        raise ValueError("Profiles can only be applied to the eager, int8 and bf16 backends. "
+                         "Export the model with --profile for the others.")
+    if 'min_size' in settings:
+        model.transform.min_size = (settings['min_size'],)
+    if 'max_size' in settings:
+        model.transform.max_size = settings['max_size']
+    if 'rpn_pre_nms_top_n_test' in settings:
+        model.rpn._pre_nms_top_n['testing'] = settings['rpn_pre_nms_top_n_test']
+    if 'rpn_post_nms_top_n_test' in settings:
+        model.rpn._post_nms_top_n['testing'] = settings['rpn_post_nms_top_n_test']
+    if 'box_detections_per_img' in settings:
+        model.roi_heads.detections_per_img = settings['box_detections_per_img']
+    if 'box_score_thresh' in settings:
+        model.roi_heads.score_thresh = settings['box_score_thresh']
+    return model
+
+# The model to run, by backend: 'eager' unpickles the model and loads its
+# parameters (load_model), 'torchscript' and 'onnxruntime' load an export from
+# export_model.py, 'int8' loads the quantized parameters from calibrate_int8.py
+# (model_path) into the eager model, and 'bf16' runs the eager model under
+# autocast. threads is only used by onnxruntime.
+backends = ('eager', 'torchscript', 'onnxruntime', 'int8', 'bf16')
+
+def load_backend(backend='eager', model_path=None, params_path='MaskModelParams.pth', threads=None):
+    if backend == 'torchscript':
+        return load_scripted_model(model_path or 'MaskInstanceModel.pt')
+    if backend == 'onnxruntime':
+        return load_onnx_model(model_path or 'MaskInstanceModel.onnx', threads)
+    if backend == 'int8':
+        return load_quantized_model(model_path or 'MaskModelParams_int8.pth', params_path=params_path)
+    if backend == 'bf16':
+        return autocast_detector(load_model(model_path or 'MaskInstanceModel.pth', params_path))
+    if backend == 'eager':
+        return load_model(model_path or 'MaskInstanceModel.pth', params_path)
+    raise ValueError("Unknown backend {}. Use one of {}.".format(backend, ", ".join(backends)))
 
 """The model returns a **Dict[Tensor]** during training, containing the classification and regression losses for both the RPN and the R-CNN, and the mask loss.
 
@@ -119,160 +316,223 @@ During inference, the model requires only the input tensors, and returns the pos
 
 """
 
-# Where are the new images that will need to be analyzed going to be stored?
-#img_dir = input("Please provide a directory path that has the images awaiting analysis.\n")
-img_dir = "/content/drive/MyDrive/APHIS Farm Bill (2020Milestones)/Protocols/For John/images/New set for John/Images_new_cartridge_2022/cropped"
-#"/content/drive/MyDrive/APHIS Farm Bill (2020Milestones)/Protocols/For John/images/New set for John/collection/four_chambers/imgs_centercropped"
-
-if os.path.exists(img_dir) == "False":
-    raise TypeError("The path provided does not exist. Do you need to provide a leading '/' (on Windows, you need to provide 'C:\' instead).")
-
-# Just base name of file for possibly using as short name in later functions.
-waiting_images = list()
-# Complete path of files
-w_im_dir_read = list()
-
-for file in os.listdir(img_dir):
-    if file.endswith(".png"):
-        waiting_images.append( file)
-        w_im_dir_read.append(os.path.join(img_dir, file))
-    
-waiting_images = sorted(waiting_images)
-w_im_dir_read = sorted(w_im_dir_read)
-        
-# Check for even number of images. Otherwise, a 00 or 61 is probably missing.
-if len(waiting_images) % 2 == 1:
-  raise IndexError("Error: odd number of images. Is there a 0 min. image and a 61 min. image for each assay?")
-
-print("The following images will be analyzed:{}\n".format(waiting_images))
-
-img_count = 0
-
-
-# Need a way to check if image have been processed or not. Have to set up a 
-# tracking table.
-
-im_start_lis = list()
-im_perm_lis = list()
-
-for i in range(len(waiting_images)):
-    # "read_image" is the Torchvision version of image ingestion.
-    im_start_lis.append(read_image(w_im_dir_read[i]).to(device))
-    # Change Torch-based image read to shape that plt can render. (4,1600,1600) 
-    # to (1600,1600,4) 
-    im_perm_lis.append(im_start_lis[i].permute(1,2,0))
-
-batch_int = list()
-
-for i,j in zip(range(0,len(im_start_lis),2),range(1,len(im_start_lis),2)):
-    # Gather inputs for batches. The model is run on each batch for the 
-    # comparison.
-    batch_int.append(torch.stack([im_start_lis[i], im_start_lis[j]]))
-    #batch_lis.append(batch(convert_image_dtype(batch_int[i], dtype=torch.float)))
-
-batch = list()
-
-for i in range(len(batch_int)):
-    batch.append(convert_image_dtype(batch_int[i], dtype=torch.float))
+# The images waiting for analysis, one item per pair (the 0 min. and 61 min.
+# images of an assay). Images are read with "read_image", the Torchvision
+# version of image ingestion, only when the item is asked for, so a DataLoader
+# can read them in worker processes while the model runs on the previous batch.
+class waiting_pairs(torch.utils.data.Dataset):
+    def __init__(self, img_paths):
+        self.img_paths = img_paths
+
+    def __getitem__(self, idx):
+        # uint8 [2, C, H, W]
+        return torch.stack([read_image(self.img_paths[2*idx]),
+                            read_image(self.img_paths[2*idx+1])])
+
+    def __len__(self):
+        return len(self.img_paths)//2
+
+# Like waiting_pairs, but the images are rows of a crop store written by the
+# image prep app (see crop_store.py), found by their file names, so nothing is
+# decoded.
+class stored_pairs(stored_crops):
+    def __getitem__(self, idx):
+        # uint8 [2, C, H, W]
+        return torch.stack([self.crop(2*idx), self.crop(2*idx+1)])
+
+    def __len__(self):
+        return len(self.rows)//2
+
+# Streams the pairs in order, pairs_per_batch at a time, decoding in num_workers
+# processes (each keeps two batches read ahead, the DataLoader default). Batches come out as
+# uint8 [2*pairs_per_batch, C, H, W], in pinned memory when a GPU is used so the
+# copy to the device can overlap with other work. With a store directory the
+# images are read from that crop store instead of their PNGs.
+def pair_loader(img_paths, pairs_per_batch=2, num_workers=2, store=None):
+    pairs = waiting_pairs(img_paths) if store is None else stored_pairs(store, img_paths)
+    return torch.utils.data.DataLoader(
+        pairs, batch_size=pairs_per_batch, shuffle=False,
+        num_workers=num_workers, pin_memory=device.type == 'cuda')
 
 # Creates outputs from the model that can be used with other functions and 
 # classes created later on. 
-# This will grab the first of the pair of images to be compared.
-def get_first_outputs(image, model, threshold):
-    with torch.no_grad():
-        # forward pass of the image through the modle
-        outputs = model(image)
-    
-    # get all the scores
-    scores = list(outputs[0]['scores'].detach().cpu().numpy())
-    # index of those scores which are above a certain threshold
-    thresholded_preds_indices = [scores.index(i) for i in scores if i > threshold]
-    thresholded_preds_count = len(thresholded_preds_indices)
-    # get the masks
-    masks = (outputs[0]['masks']>0.5).squeeze().detach().cpu().numpy()
-    # discard masks for objects which are below threshold
-    masks = masks[:thresholded_preds_count]
+# This parses the output of the model for one image. Everything is selected
+# with a boolean mask on the scores and the masks are thresholded and merged
+# where the model ran, so only the final union mask (bool [H, W], on the model's
+# device) and the kept boxes and labels are left for later steps.
+def parse_output(output, threshold):
+    # detections with a score above the threshold
+    keep = output['scores'] > threshold
+    # threshold the soft masks of those detections and merge them into one
+    mask = (output['masks'][keep] > 0.5).any(dim=0).squeeze(0)
     # get the bounding boxes, in (x1, y1), (x2, y2) format
-    boxes = [[(int(i[0]), int(i[1])), (int(i[2]), int(i[3]))]  for i in outputs[0]['boxes'].detach().cpu()]
-    # discard bounding boxes below threshold value
-    boxes = boxes[:thresholded_preds_count]
+    boxes = [[(int(i[0]), int(i[1])), (int(i[2]), int(i[3]))]  for i in output['boxes'][keep].detach().cpu()]
     # get the classes labels
-    labels = [coco_names[i] for i in outputs[0]['labels']]
-    return masks, boxes, labels
-
-# Creates outputs from the model that can be used with other functions and 
-# classes created later on. 
-# This will provide the second of the pair of images to be compared.
-def get_second_outputs(image, model, threshold):
+    labels = [coco_names[i] for i in output['labels'][keep].tolist()]
+    return mask, boxes, labels
+
+# The part of the image each detection's mask can have been pasted into, as
+# int64 [N, 4] windows (x1, y1, x2, y2 in pixels, x2 and y2 exclusive, clipped
+# to the image). torchvision pastes the mask head's mask_size x mask_size output,
+# padded by one cell on each side, over the box grown by (mask_size + 2) /
+# mask_size; one more pixel on each side covers the rounding. Every pixel of a
+# mask outside its window is zero.
+def mask_windows(boxes, image_size, mask_size=28):
+    height, width = image_size
+    pad_x = (boxes[:, 2] - boxes[:, 0]) / mask_size + 1
+    pad_y = (boxes[:, 3] - boxes[:, 1]) / mask_size + 1
+    windows = torch.stack([(boxes[:, 0] - pad_x).floor().clamp(0, width),
+                           (boxes[:, 1] - pad_y).floor().clamp(0, height),
+                           (boxes[:, 2] + pad_x).ceil().clamp(0, width),
+                           (boxes[:, 3] + pad_y).ceil().clamp(0, height)], dim=1)
+    return windows.long()
+
+# Like parse_output, but keeps every detection above the threshold as its own
+# mask for the chamber analysis. Each mask is only thresholded inside its
+# window (see mask_windows), so no image-sized mask is made per detection: the
+# masks come out as a list of bool [h, w] crops, with their windows (int64
+# [N, 4]) and labels as tensors, all on the model's device.
+def parse_instances(output, threshold):
+    keep = (output['scores'] > threshold).nonzero().flatten()
+    windows = mask_windows(output['boxes'][keep], output['masks'].shape[-2:])
+    masks = [output['masks'][i, 0, y1:y2, x1:x2] > 0.5
+             for i, (x1, y1, x2, y2) in zip(keep.tolist(), windows.tolist())]
+    return masks, windows, output['labels'][keep]
+
+# Runs one forward pass over a batch of images and returns the parsed outputs
+# (mask, boxes, labels by default) for every image in it, in the same order.
+def get_outputs(image, model, threshold, parse=parse_output):
     with torch.no_grad():
         # forward pass of the image through the modle
         outputs = model(image)
-    
-    # get all the scores
-    scores = list(outputs[1]['scores'].detach().cpu().numpy())
-    # index of those scores which are above a certain threshold
-    thresholded_preds_indices = [scores.index(i) for i in scores if i > threshold]
-    thresholded_preds_count = len(thresholded_preds_indices)
-    # get the masks
-    masks = (outputs[1]['masks']>0.5).squeeze().detach().cpu().numpy()
-    # discard masks for objects which are below threshold
-    masks = masks[:thresholded_preds_count]
-    # get the bounding boxes, in (x1, y1), (x2, y2) format
-    boxes = [[(int(i[0]), int(i[1])), (int(i[2]), int(i[3]))]  for i in outputs[1]['boxes'].detach().cpu()]
-    # discard bounding boxes below threshold value
-    boxes = boxes[:thresholded_preds_count]
-    # get the classes labels
-    labels = [coco_names[i] for i in outputs[1]['labels']]
-    return masks, boxes, labels
-
-mod_res_all = list()
-for b in range(len(batch)):
-    mod_res_all.append(get_first_outputs(batch[b], model, 0.9))
-    mod_res_all.append(get_second_outputs(batch[b], model, 0.9))
-
-mask_composite_num = list()
-mask_mult = list()
-img_mask_comp = list()
-
-
-for i in range(len(mod_res_all)):
-    # This is a logical operation to get the multiple arrays of the masks 
-    # flattened down to a single array (layer or channel in an imagery sense) 
-    # and to change the mask from T/F to 1/0.
-    mask_composite_num.append((mod_res_all[i][0].sum(axis=0) > 0)*1)
-    # To run the next function, the mask needs to have 3 channels/layers/arrays.
-    mask_mult.append(np.stack((mask_composite_num[i], mask_composite_num[i], mask_composite_num[i]), axis=-1))
-    # Multiple image and mask. 
-    img_mask_comp.append(im_perm_lis[i]*mask_mult[i])
-
-# Get values of green channels, after dividing the np.ndarrays into sections
-def green_cn(x):
-    if type(x) == torch.Tensor:
-        #print(f"{x} is a Tensor. Changed to np.array")
-        x = x.detach().cpu().numpy()
-    #elif type(x) == PIL.Image.Image:
-        #print(f"{x} is a PIL.Image. Changed to np.array")
-    #    x = np.array(x)
-    # x is an np.ndarray!
-    width, height = x.shape[0:2]
-    # set halves
-    v_half = height//2
-    h_half = width//2
-    #split the halves into the quarters
-    up_l_gr = x[:v_half,:h_half,1]
-    up_r_gr = x[:v_half,h_half+1:,1]
-    lw_l_gr = x[v_half+1:,:h_half,1]
-    lw_r_gr = x[v_half+1:,h_half+1:,1]
-    uplg_mean = up_l_gr[np.nonzero(up_l_gr)].mean()
-    uprg_mean = up_r_gr[np.nonzero(up_r_gr)].mean()
-    lwlg_mean = lw_l_gr[np.nonzero(lw_l_gr)].mean()
-    lwrg_mean = lw_r_gr[np.nonzero(lw_r_gr)].mean()
-    return lwlg_mean,uplg_mean,uprg_mean,lwrg_mean
-
-green_val = list()
-
-for i in range(len(img_mask_comp)):
-    green_val.append(green_cn(img_mask_comp[i]))
+    return [parse(output, threshold) for output in outputs]
+
+# Mean of the non-zero green values inside the union mask in each quadrant of
+# the image, for a batch of images (uint8 [B, C, H, W]) and their union masks
+# (bool [B, H, W]), as a float64 [B, 4] tensor on the same device, in the order
+# lower left, upper left, upper right, lower right. The image is split exactly
+# in half. The mask is applied to the green plane alone, giving one uint8 plane
+# of the same size, and each quadrant is summed and counted straight from a
+# view of it, with no masked RGB copy or wider temporaries. A quadrant with
+# nothing in the mask gives nan, as np.mean of an empty array does.
+def green_quadrants(images, masks):
+    height, width = images.shape[-2:]
+    v_half, h_half = height//2, width//2
+    green = images[:, 1] * masks
+    quadrants = [green[:, v_half:, :h_half], green[:, :v_half, :h_half],
+                 green[:, :v_half, h_half:], green[:, v_half:, h_half:]]
+    sums = torch.stack([quadrant.sum(dim=(1, 2)) for quadrant in quadrants], dim=1)
+    counts = torch.stack([torch.count_nonzero(quadrant, dim=(1, 2)) for quadrant in quadrants], dim=1)
+    return sums.double() / counts
+
+# Chamber layouts. A layout file is JSON with a list of chambers, each with a
+# name and a box [x1, y1, x2, y2] given as fractions of the image width and
+# height, so the same file works at any crop size. Chambers with "test": true
+# are called positive or negative; the others only count towards the assay
+# level. four_chambers.json is the quadrant layout threshold_test assumes; an 8
+# or 16 chamber cartridge only needs a file with more chambers in it.
+def load_layout(layout_path):
+    with open(layout_path) as f:
+        layout = json.load(f)
+    for chamber in layout['chambers']:
+        if len(chamber['box']) != 4:
+            raise ValueError("Chamber {} needs a box of four numbers, [x1, y1, x2, y2].".format(chamber['name']))
+    return layout
+
+# Which chamber each instance is in, by the centroid of its mask (the crops and
+# windows from parse_instances, in an image of image_size): a long [N] tensor
+# of indexes into layout['chambers'], -1 where the centroid is in none of them.
+# If chambers overlap, the first one in the file wins.
+def assign_chambers(masks, windows, layout, image_size):
+    height, width = image_size
+    boxes = torch.tensor([chamber['box'] for chamber in layout['chambers']],
+                         dtype=torch.float, device=windows.device)
+    cx = torch.zeros(len(masks), device=windows.device)
+    cy = torch.zeros(len(masks), device=windows.device)
+    for i, (mask, (x1, y1, x2, y2)) in enumerate(zip(masks, windows.tolist())):
+        area = mask.sum().clamp(min=1)
+        cy[i] = (mask.sum(dim=1) * torch.arange(y1, y2, device=mask.device)).sum() / area
+        cx[i] = (mask.sum(dim=0) * torch.arange(x1, x2, device=mask.device)).sum() / area
+    # centroids of pixel centres, as fractions of the image size
+    cx = ((cx + 0.5) / width).unsqueeze(1)
+    cy = ((cy + 0.5) / height).unsqueeze(1)
+    inside = (cx >= boxes[:, 0]) & (cx < boxes[:, 2]) & (cy >= boxes[:, 1]) & (cy < boxes[:, 3])
+    return torch.where(inside.any(dim=1), inside.long().argmax(dim=1), -1)
+
+# Histogram of the green values under each instance mask (crops and windows
+# from parse_instances), long [N, 256], one bincount over each window. Green is
+# uint8, so every statistic below comes out of these exactly, without sorting
+# the pixels of each instance.
+def green_histograms(image, masks, windows):
+    hist = torch.zeros(len(masks), 256, dtype=torch.long, device=image.device)
+    for i, (mask, (x1, y1, x2, y2)) in enumerate(zip(masks, windows.tolist())):
+        hist[i] = torch.bincount(image[1, y1:y2, x1:x2][mask].long(), minlength=256)
+    return hist
+
+# Mean, median and percentiles of the green values from histograms [N, 256].
+# Percentiles are the lowest value with at least that share of the pixels at
+# or below it. Rows with no pixels give nan.
+def histogram_stats(hist, percentiles=(10, 25, 75, 90)):
+    count = hist.sum(dim=1)
+    values = torch.arange(256, device=hist.device, dtype=torch.float64)
+    empty = torch.full(count.shape, float('nan'), dtype=torch.float64, device=hist.device)
+    cdf = hist.cumsum(dim=1)
+    def percentile(q):
+        below = cdf < (q / 100 * count).unsqueeze(1)
+        return torch.where(count > 0, below.sum(dim=1).double(), empty)
+    stats = {'pixels': count,
+             'mean': torch.where(count > 0, (hist * values).sum(dim=1) / count, empty),
+             'median': percentile(50)}
+    for q in percentiles:
+        stats['p{}'.format(q)] = percentile(q)
+    return stats
+
+# Mean of each channel of the image in another colour space ('hsv' or 'lab',
+# OpenCV's 8 bit scales) under each instance mask (crops and windows from
+# parse_instances), float64 [N, 3].
+def colour_means(image, masks, windows, space):
+    codes = {'hsv': cv2.COLOR_RGB2HSV, 'lab': cv2.COLOR_RGB2LAB}
+    rgb = image[:3].permute(1, 2, 0).cpu().numpy()
+    converted = torch.from_numpy(cv2.cvtColor(np.ascontiguousarray(rgb), codes[space]))
+    converted = converted.to(windows.device).double()
+    means = torch.zeros(len(masks), 3, dtype=torch.float64, device=windows.device)
+    for i, (mask, (x1, y1, x2, y2)) in enumerate(zip(masks, windows.tolist())):
+        means[i] = converted[y1:y2, x1:x2][mask].mean(dim=0)
+    return means
+
+# Per-instance and per-chamber statistics for one image (uint8 [C, H, W]) from
+# its instance masks, the crops and windows from parse_instances. Each chamber's
+# statistics pool the pixels of all the instances assigned to it. colour=('hsv',)
+# etc. adds the mean of those channels per instance.
+def chamber_stats(image, masks, windows, layout, colour=()):
+    chamber = assign_chambers(masks, windows, layout, image.shape[-2:])
+    hist = green_histograms(image, masks, windows)
+    instances = histogram_stats(hist)
+    instances['chamber'] = chamber
+    for space in colour:
+        instances[space] = colour_means(image, masks, windows, space)
+    pooled = torch.zeros(len(layout['chambers']), 256, dtype=hist.dtype, device=hist.device)
+    assigned = chamber >= 0
+    pooled.index_add_(0, chamber[assigned], hist[assigned])
+    return instances, histogram_stats(pooled)
+
+# threshold_test for any layout. z and s are the chamber statistics of the 0
+# min. and 61 min. images; the assay level is set from every chamber of the 0
+# min. image, and the test chambers of the 61 min. image are compared with it.
+# A test chamber with no well assigned to it is reported as such.
+def chamber_test(z, s, layout, stat='mean'):
+    z_values = z[stat].cpu().numpy()
+    s_values = s[stat].cpu().numpy()
+    z_threshold = np.nanmean(z_values)+3*np.nanstd(z_values)
+    status_list = [dict(Assay_level=z_threshold)]
+    for i, chamber in enumerate(layout['chambers']):
+        if chamber.get('test', False):
+            if np.isnan(s_values[i]):
+                status = "no well detected"
+            else:
+                status = "negative" if s_values[i] <= z_threshold else "positive"
+            status_list.append({chamber['name'] + '_status_and_score': [status, s_values[i]]})
+    return status_list
 
 def threshold_test(z,s):
     z_threshold = np.mean(z)+3*np.std(z)
@@ -295,30 +555,56 @@ def threshold_test(z,s):
 
     return status_list
 
-pair_idx = list()
-
-for i in range(0,len(green_val),2):
-    j = i+1
-    pair_idx.append((i, j))
-
-pair_idx
-
-threshold_list = list()
-
-for i in range(len(pair_idx)):
-    #print(i)
-    threshold_list.append(threshold_test(green_val[pair_idx[i][0]],green_val[pair_idx[i][1]]))
-
-for i in range(len(threshold_list)):
-    print("Result for {} is {}.\n".format(waiting_images[pair_idx[i][0]],threshold_list[i]))
-
-# Add something like "image {}" later
-#print('Results after modeling {} and {} are:\n{} \n{} \n{} \n{}'.format(waiting_images[0],
-#                                                                        waiting_images[2],
-#                                                                        threshold_result[0], 
-#                                                              threshold_result[1], 
-#                                                              threshold_result[2], 
-#                                                              threshold_result[3]))
+# The statistics of one image from chamber_stats, as plain Python for a result:
+# a list of wells, each with the name of its chamber (None if it is in none) and
+# its statistics, and a dict of the chambers' statistics by name.
+def stats_to_result(instances, chambers, layout):
+    names = [chamber['name'] for chamber in layout['chambers']]
+    columns = {key: value.tolist() for key, value in instances.items()}
+    wells = list()
+    for i, chamber in enumerate(columns.pop('chamber')):
+        well = {'chamber': names[chamber] if chamber >= 0 else None}
+        well.update({key: values[i] for key, values in columns.items()})
+        wells.append(well)
+    chambers = {key: value.tolist() for key, value in chambers.items()}
+    return {'wells': wells,
+            'chambers': {name: {key: values[i] for key, values in chambers.items()} for i, name in enumerate(names)}}
+
+# Runs the model once over a batch of pairs (uint8 [2*pairs, C, H, W] on the
+# device, 0 min. and 61 min. images alternating) and returns the result of each
+# pair, as threshold_test or, with a layout, chamber_test gives it. With a
+# layout and well_stats, each result ends with a Stats item holding the
+# statistics of every well and chamber of both images (stats_to_result), with
+# the well means in the colour spaces in colour too.
+def analyze_pairs(batch_int, model, threshold=0.9, layout=None, colour=(), well_stats=False):
+    batch = convert_image_dtype(batch_int, dtype=torch.float)
+    if layout is None:
+        masks = torch.stack([mask for mask, boxes, labels in get_outputs(batch, model, threshold)])
+        scores = list(green_quadrants(batch_int, masks).cpu().numpy())
+        return [threshold_test(z, s) for z, s in zip(scores[0::2], scores[1::2])]
+    scores, stats = list(), list()
+    for image, (masks, windows, labels) in zip(batch_int, get_outputs(batch, model, threshold, parse_instances)):
+        instances, chambers = chamber_stats(image, masks, windows, layout, colour if well_stats else ())
+        scores.append(chambers)
+        if well_stats:
+            stats.append(stats_to_result(instances, chambers, layout))
+    results = [chamber_test(z, s, layout) for z, s in zip(scores[0::2], scores[1::2])]
+    if well_stats:
+        for result, z, s in zip(results, stats[0::2], stats[1::2]):
+            result.append(dict(Stats={'zero': z, 'end': s}))
+    return results
+
+# A result from analyze_pairs with plain floats, and None for nan, for JSON.
+def result_to_json(status_list):
+    def plain(value):
+        if isinstance(value, dict):
+            return {key: plain(v) for key, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [plain(v) for v in value]
+        if isinstance(value, (float, np.floating)):
+            return None if np.isnan(value) else float(value)
+        return value
+    return [plain(item) for item in status_list]
 
 # Optional plotting. Good for a sanity check.
 def draw_segmentation_map(image, masks, boxes, labels):
@@ -406,32 +692,178 @@ def four_cn_image(x):
 # Example
 #w1,w2,w3,w4 = four_cn(z_img_mask_comp)
 
-# Optional plotting II.
-plt.figure(figsize = (28,7))
-plt.subplot(1,4,1)
-#plt.imshow(w1)
-plt.subplot(1,4,2)
-#plt.imshow(w2)
-plt.subplot(1,4,3)
-#plt.imshow(w3)
-plt.subplot(1,4,4)
-#plt.imshow(w4)
-
-# Completely optional III. Doesn't even make for sanity check.
-plt.figure(figsize=(15,15))
-plt.subplot(4,2,1)
-#plt.imshow(z_img_mask_comp)
-plt.subplot(4,2,2)
-#plt.imshow(s_img_mask_comp)
-plt.subplot(4,2,3)
-#plt.imshow(z_img_mask_comp[:,:,0])
-plt.subplot(4,2,4)
-#plt.imshow(s_img_mask_comp[:,:,0])
-plt.subplot(4,2,5)
-#plt.imshow(z_img_mask_comp[:,:,1])
-plt.subplot(4,2,6)
-#plt.imshow(s_img_mask_comp[:,:,1])
-plt.subplot(4,2,7)
-#plt.imshow(z_img_mask_comp[:,:,2])
-plt.subplot(4,2,8)
-#plt.imshow(s_img_mask_comp[:,:,2])
\ No newline at end of file
+# Adds the options that pick the model and how it runs (--backend, --model,
+# --params, --threads, --profile and --threshold) to an argparse parser, for
+# load_from_args. This script and green_value_server.py take all of them;
+# export_model.py, which always exports the pickled model, only takes --profile
+# and --threshold (profile_only).
+def add_model_args(parser, profile_only=False):
+    if not profile_only:
+        parser.add_argument("--backend", default="eager", choices=backends,
+                            help="run the pickled model, a TorchScript or ONNX export of it from export_model.py, "
+                                 "its int8 version from calibrate_int8.py, or the model under bf16 autocast")
+        parser.add_argument("--model", default=None,
+                            help="model file (default MaskInstanceModel.pth, .pt for torchscript, "
+                                 ".onnx for onnxruntime, MaskModelParams_int8.pth for int8)")
+        parser.add_argument("--params", default="MaskModelParams.pth",
+                            help="model parameters file (eager, int8 and bf16)")
+        parser.add_argument("--threads", type=int, default=None,
+                            help="CPU threads for the model (default: torch's and ONNX Runtime's own choice)")
+    parser.add_argument("--profile", default=None, choices=sorted(model_profiles),
+                        help="inference settings to export the model with" if profile_only else
+                             "inference settings to run the model with (eager, int8 and bf16)")
+    parser.add_argument("--threshold", type=float, default=0.9,
+                        help="lowest score of a detection that is kept" + (
+                            "; the exported model drops the others, so run it with this --threshold or a higher one"
+                            if profile_only else ""))
+    return parser
+
+# Loads the model for the add_model_args options and sets it up with them. The
+# box head also drops every detection at or below --threshold, which the
+# analysis would drop anyway, so they never reach the mask head or get their
+# masks pasted (by default it only drops those at or below 0.05). NMS only lets
+# a box suppress boxes that score lower, so the detections kept are the same.
+# The torchscript and onnxruntime models get this from export_model.py.
+def load_from_args(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = load_backend(args.backend, args.model, args.params, args.threads)
+    if args.backend in ('eager', 'int8', 'bf16'):
+        settings = dict(model_profiles[args.profile]) if args.profile else dict()
+        settings['box_score_thresh'] = args.threshold
+        apply_profile(model, settings)
+    elif args.profile:
+        apply_profile(model, args.profile)
+    return model
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Segment the wells in assay image pairs and call each chamber positive or negative.")
+    parser.add_argument("img_dir", nargs="?", default=None,
+                        help="directory with the cropped 0 min. and 61 min. PNGs of each assay (with --store, "
+                             "which crops of the store to analyze; default all of them)")
+    add_model_args(parser)
+    parser.add_argument("--store", default=None,
+                        help="crop store from the image prep app (ingest --store) to read the images from, "
+                             "instead of decoding the PNGs")
+    parser.add_argument("--pairs-per-batch", type=int, default=2,
+                        help="pairs that go through the model in one forward pass")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="processes that read images ahead of the model (0 reads them in this one)")
+    parser.add_argument("--layout", default=None,
+                        help="chamber layout file; without one the images are split into quadrants")
+    parser.add_argument("--well-stats", action="store_true",
+                        help="add the statistics of every well and chamber to the results (with --layout)")
+    parser.add_argument("--colour", nargs="*", default=(), choices=("hsv", "lab"),
+                        help="colour spaces to add per-well means in to the well statistics (with --layout; "
+                             "implies --well-stats)")
+    args = parser.parse_args(argv)
+    args.well_stats = args.well_stats or bool(args.colour)
+    if args.well_stats and not args.layout:
+        parser.error("--well-stats and --colour need --layout")
+    if args.img_dir is None and args.store is None:
+        parser.error("give the directory with the images, or --store")
+    if args.img_dir is not None and not os.path.isdir(args.img_dir):
+        parser.error("{} does not exist. Do you need to provide a leading '/' (on Windows, you need to provide "
+                     "'C:\\' instead)?".format(args.img_dir))
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # Where are the new images that will need to be analyzed going to be stored?
+    img_dir = args.img_dir
+
+    # Just base name of file for possibly using as short name in later functions.
+    waiting_images = list()
+    # Complete path of files
+    w_im_dir_read = list()
+
+    if img_dir is None:
+        # Every crop in the store; they are read from it by name.
+        waiting_images = list(read_index(args.store))
+        w_im_dir_read = list(waiting_images)
+    else:
+        for file in os.listdir(img_dir):
+            if file.endswith(".png"):
+                waiting_images.append( file)
+                w_im_dir_read.append(os.path.join(img_dir, file))
+    
+    waiting_images = sorted(waiting_images)
+    w_im_dir_read = sorted(w_im_dir_read)
+        
+    # Check for even number of images. Otherwise, a 00 or 61 is probably missing.
+    if len(waiting_images) % 2 == 1:
+      raise IndexError("Error: odd number of images. Is there a 0 min. image and a 61 min. image for each assay?")
+
+    print("The following images will be analyzed:{}\n".format(waiting_images))
+
+    img_count = 0
+
+
+    # Need a way to check if image have been processed or not. Have to set up a 
+    # tracking table.
+
+    model = load_from_args(args)
+
+    # --pairs-per-batch pairs go through the model in one forward pass while
+    # --workers processes read images ahead of it. Only one batch of images is on
+    # the device at a time, however many images are waiting.
+    # With --layout each detected well is put in a chamber by its centroid and
+    # scored on its own pixels, instead of the image being cut into four
+    # quadrants. --well-stats adds the statistics of every well and chamber to the
+    # results, and --colour can add 'hsv' and/or 'lab' means per well to them.
+    layout = load_layout(args.layout) if args.layout else None
+
+    threshold_list = list()
+
+    for batch_int in pair_loader(w_im_dir_read, args.pairs_per_batch, args.workers, args.store):
+        batch_int = batch_int.flatten(0, 1).to(device, non_blocking=True)
+        threshold_list.extend(analyze_pairs(batch_int, model, args.threshold, layout, args.colour,
+                                            args.well_stats))
+
+    pair_idx = list()
+
+    for i in range(0,len(waiting_images),2):
+        j = i+1
+        pair_idx.append((i, j))
+
+    for i in range(len(threshold_list)):
+        print("Result for {} is {}.\n".format(waiting_images[pair_idx[i][0]],threshold_list[i]))
+
+    # Add something like "image {}" later
+    #print('Results after modeling {} and {} are:\n{} \n{} \n{} \n{}'.format(waiting_images[0],
+    #                                                                        waiting_images[2],
+    #                                                                        threshold_result[0], 
+    #                                                              threshold_result[1], 
+    #                                                              threshold_result[2], 
+    #                                                              threshold_result[3]))
+
+    # Optional plotting II.
+    plt.figure(figsize = (28,7))
+    plt.subplot(1,4,1)
+    #plt.imshow(w1)
+    plt.subplot(1,4,2)
+    #plt.imshow(w2)
+    plt.subplot(1,4,3)
+    #plt.imshow(w3)
+    plt.subplot(1,4,4)
+    #plt.imshow(w4)
+
+    # Completely optional III. Doesn't even make for sanity check.
+    plt.figure(figsize=(15,15))
+    plt.subplot(4,2,1)
+    #plt.imshow(z_img_mask_comp)
+    plt.subplot(4,2,2)
+    #plt.imshow(s_img_mask_comp)
+    plt.subplot(4,2,3)
+    #plt.imshow(z_img_mask_comp[:,:,0])
+    plt.subplot(4,2,4)
+    #plt.imshow(s_img_mask_comp[:,:,0])
+    plt.subplot(4,2,5)
+    #plt.imshow(z_img_mask_comp[:,:,1])
+    plt.subplot(4,2,6)
+    #plt.imshow(s_img_mask_comp[:,:,1])
+    plt.subplot(4,2,7)
+    #plt.imshow(z_img_mask_comp[:,:,2])
+    plt.subplot(4,2,8)
+    #plt.imshow(s_img_mask_comp[:,:,2])
\ No newline at end of file
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Measures speed against mask quality over the model's inference settings.
+
+Runs the chip images through the eager model for every combination of input
+size, RPN proposals and detections per image given, and prints the per-image
+latency and the IoU of the union of the well masks with a reference:
+the ground truth masks (as used for training) when --masks is given, or else
+the model with its 'coco' settings. The named profiles in model_profiles are
+run first. Pick the fastest setting whose IoU is good enough:
+
+    python sweep_profiles.py path/to/cropped --masks path/to/masks --min-sizes 480 640 800 --top-n 100 150 300
+"""
+
+import argparse
+import itertools
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.io import ImageReadMode, read_image
+from torchvision.transforms.functional import convert_image_dtype
+
+from model_to_green_value import apply_profile, device, get_outputs, load_model, model_profiles
+
+
+# Union of the wells of a ground truth mask image, in which each well has its
+# own value and 0 is background. As in training, the four highest values are
+# the wells; anything else is noise.
+def ground_truth_union(path):
+    mask = np.array(Image.open(path))
+    ids = np.unique(mask)
+    ids = ids[ids != 0][-4:]
+    return torch.from_numpy(np.isin(mask, ids)).to(device)
+
+
+def iou(mask, reference):
+    union = (mask | reference).sum().item()
+    return (mask & reference).sum().item() / union if union else 1.0
+
+
+# Union masks of the images and the seconds each took.
+def run_settings(model, settings, images, threshold):
+    apply_profile(model, settings)
+    get_outputs(images[0][None], model, threshold)
+    masks, seconds = list(), list()
+    for image in images:
+        start = time.perf_counter()
+        mask, boxes, labels = get_outputs(image[None], model, threshold)[0]
+        seconds.append(time.perf_counter() - start)
+        masks.append(mask)
+    return masks, seconds
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep the model's inference settings for speed against mask IoU.")
+    parser.add_argument("images", help="a directory of .png chip images")
+    parser.add_argument("--masks", default=None,
+                        help="a directory of ground truth masks, one per image in the same sorted order")
+    parser.add_argument("--min-sizes", nargs="+", type=int, default=[480, 640, 800],
+                        help="sizes of the shorter side the images are resized to (max_size is set the same)")
+    parser.add_argument("--top-n", nargs="+", type=int, default=[100, 150, 300, 1000],
+                        help="RPN proposals kept before and after NMS")
+    parser.add_argument("--detections", nargs="+", type=int, default=[32, 100], help="detections per image")
+    parser.add_argument("--threshold", type=float, default=0.9, help="lowest score of a detection that is kept")
+    parser.add_argument("--model", default="MaskInstanceModel.pth", help="pickled model file")
+    parser.add_argument("--params", default="MaskModelParams.pth", help="model parameters file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    paths = sorted(os.path.join(args.images, file) for file in os.listdir(args.images) if file.endswith(".png"))
+    images = [convert_image_dtype(read_image(path, ImageReadMode.RGB), dtype=torch.float).to(device) for path in paths]
+    model = load_model(args.model, args.params)
+
+    if args.masks:
+        mask_paths = sorted(os.listdir(args.masks))
+        if len(mask_paths) != len(paths):
+            raise IndexError("There are {} images but {} masks.".format(len(paths), len(mask_paths)))
+        references = [ground_truth_union(os.path.join(args.masks, path)) for path in mask_paths]
+        against = "ground truth"
+    else:
+        references, seconds = run_settings(model, model_profiles['coco'], images, args.threshold)
+        against = "coco settings"
+
+    sweep = [(name, settings) for name, settings in sorted(model_profiles.items())]
+    for min_size, top_n, detections in itertools.product(args.min_sizes, args.top_n, args.detections):
+        sweep.append(("-", dict(min_size=min_size, max_size=min_size, rpn_pre_nms_top_n_test=top_n,
+                                rpn_post_nms_top_n_test=top_n, box_detections_per_img=detections)))
+
+    print("IoU of the union well masks with the {}.".format(against))
+    print("{:<10} {:>8} {:>8} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+        "profile", "min_size", "max_size", "top_n", "dets", "p50 ms", "p95 ms", "mean IoU", "min IoU"))
+    for name, settings in sweep:
+        masks, seconds = run_settings(model, settings, images, args.threshold)
+        ious = [iou(mask, reference) for mask, reference in zip(masks, references)]
+        print("{:<10} {:>8} {:>8} {:>6} {:>6} {:>9.1f} {:>9.1f} {:>9.4f} {:>9.4f}".format(
+            name, settings['min_size'], settings['max_size'], settings['rpn_post_nms_top_n_test'],
+            settings['box_detections_per_img'], np.percentile(seconds, 50) * 1000,
+            np.percentile(seconds, 95) * 1000, np.mean(ious), np.min(ious)))